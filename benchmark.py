@@ -0,0 +1,607 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from rich import box
+from rich import print as rich_print
+from rich.console import Console
+from rich.table import Table
+
+import project
+
+
+GOODBYE_FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "goodbye_replies.json")
+
+
+def main():
+    '''Run the benchmark selected on the command line'''
+    parser = argparse.ArgumentParser(description="Character Chat benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    goodbye_parser = subparsers.add_parser("goodbye", help="local goodbye classifier vs the prompt-based classifier")
+    goodbye_parser.add_argument("--live", action="store_true", help="label the fixtures with the OpenAI classifier instead of the stored labels")
+    goodbye_parser.add_argument("--threshold", type=float, default=project.LOCAL_GOODBYE_THRESHOLD)
+    goodbye_parser.add_argument("--repeat", type=int, default=1000, help="classifications per fixture when timing")
+
+    startup_parser = subparsers.add_parser("startup", help="cold-start import time of the CLI and its modules")
+    startup_parser.add_argument("--runs", type=int, default=10, help="fresh interpreters started per module")
+    startup_parser.add_argument("--top", type=int, default=8, help="heaviest imports listed per module")
+
+    sessions_parser = subparsers.add_parser("sessions", help="scripted conversations against the mock OpenAI backend")
+    sessions_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="concurrent sessions to measure")
+    sessions_parser.add_argument("--sessions", type=int, default=32, help="sessions run at each concurrency level")
+    sessions_parser.add_argument("--turns", type=int, default=5, help="user messages per session")
+    sessions_parser.add_argument("--latency", type=float, default=0.3, help="mock seconds before a response or its first token")
+    sessions_parser.add_argument("--token-latency", type=float, default=0.01, help="mock seconds between streamed tokens")
+    sessions_parser.add_argument("--cache", action="store_true", help="keep the validation cache enabled")
+    sessions_parser.add_argument("--typing", type=float, default=0.0, help="seconds the scripted user takes to type each answer")
+    sessions_parser.add_argument("--fault-rate", type=float, default=0.0, help="chance of a rate limit, server error, timeout or slow answer per request")
+
+    end_parser = subparsers.add_parser("end-detection", help="goodbye check after every reply vs the end signal in the reply")
+    end_parser.add_argument("--live", action="store_true", help="talk to OpenAI instead of the mock backend")
+    end_parser.add_argument("--turns", type=int, default=None, help="user messages per mode (default: one per goodbye fixture, 10 when live)")
+    end_parser.add_argument("--latency", type=float, default=0.3, help="mock seconds before a response or its first token")
+    end_parser.add_argument("--token-latency", type=float, default=0.01, help="mock seconds between streamed tokens")
+    end_parser.add_argument("--no-local", action="store_true", help="send every goodbye check to OpenAI instead of trying the local classifier first")
+
+    memory_parser = subparsers.add_parser("memory", help="build and query times of the transcript memory index")
+    memory_parser.add_argument("--transcripts", type=int, default=20000, help="synthetic transcripts indexed for one character")
+    memory_parser.add_argument("--exchanges", type=int, default=6, help="exchanges per transcript")
+    memory_parser.add_argument("--queries", type=int, default=200, help="queries timed")
+    memory_parser.add_argument("--seed", type=int, default=0)
+
+    subparsers.add_parser("prompts", help="tokens every call of a kind starts with, the part a provider can cache")
+
+    args = parser.parse_args()
+    if args.benchmark == "prompts":
+        bench_prompts()
+    elif args.benchmark == "memory":
+        bench_memory(transcripts=args.transcripts, exchanges=args.exchanges, queries=args.queries, seed=args.seed)
+    elif args.benchmark == "end-detection":
+        bench_end_detection(live=args.live, turns=args.turns, latency=args.latency, token_latency=args.token_latency,
+                            local_threshold=None if args.no_local else project.LOCAL_GOODBYE_THRESHOLD)
+    elif args.benchmark == "sessions":
+        bench_sessions(concurrency=args.concurrency, sessions=args.sessions, turns=args.turns,
+                       latency=args.latency, token_latency=args.token_latency, cache=args.cache, fault_rate=args.fault_rate, typing=args.typing)
+    elif args.benchmark == "goodbye":
+        bench_goodbye(live=args.live, threshold=args.threshold, repeat=args.repeat)
+    elif args.benchmark == "startup":
+        bench_startup(runs=args.runs, top=args.top)
+
+# Function to load the labeled goodbye fixtures
+def load_goodbye_fixtures(path=GOODBYE_FIXTURES_PATH):
+    '''Return the list of {"response", "label"} fixtures used to evaluate the goodbye classifiers'''
+    with open(path, encoding="utf-8") as fixtures_file:
+        return json.load(fixtures_file)
+
+# Function to compare the local goodbye classifier with the prompt-based classifier
+def bench_goodbye(live=False, threshold=project.LOCAL_GOODBYE_THRESHOLD, repeat=1000):
+    """
+    Reports how often the local classifier agrees with the prompt-based classifier, how many API
+    calls it avoids at the given threshold and how long a local classification takes.
+
+    Args:
+        live (bool): Ask OpenAI for the reference labels instead of using the stored fixture labels.
+        threshold (float): The confidence needed to skip the API call.
+        repeat (int): How many times each fixture is classified when timing the local classifier.
+
+    Returns:
+        dict: The measured agreement, fraction of API calls avoided and mean classification time.
+    """
+    fixtures = load_goodbye_fixtures()
+    local_decisions = 0
+    local_agreements = 0
+    hybrid_agreements = 0
+
+    for fixture in fixtures:
+        if live:
+            reference = project.check_for_goodbye(fixture["response"], local_threshold=None)
+        else:
+            reference = fixture["label"]
+        label, confidence = project.classify_goodbye_locally(fixture["response"])
+        if confidence >= threshold:
+            local_decisions += 1
+            local_agreements += label == reference
+            hybrid_agreements += label == reference
+        else:
+            # Escalated replies are answered by the prompt-based classifier itself, which is only the reference when live
+            hybrid_agreements += 1
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for fixture in fixtures:
+            project.classify_goodbye_locally(fixture["response"])
+    mean_us = (time.perf_counter() - start) / (repeat * len(fixtures)) * 1_000_000
+
+    results = {
+        'fixtures': len(fixtures),
+        'api_calls_avoided': local_decisions / len(fixtures),
+        'local_agreement': local_agreements / local_decisions if local_decisions else 1.0,
+        'hybrid_agreement': hybrid_agreements / len(fixtures) if live else None,
+        'mean_local_us': mean_us,
+    }
+    print_results("Goodbye classifier", {
+        "Reference labels": "OpenAI" if live else "fixtures",
+        "Threshold": f"{threshold:.2f}",
+        "Fixtures": str(results['fixtures']),
+        "API calls avoided": f"{results['api_calls_avoided']:.0%}",
+        "Agreement on local decisions": f"{results['local_agreement']:.0%}",
+        "Agreement overall": f"{results['hybrid_agreement']:.0%}" if live else "only measured with --live",
+        "Local classification (µs)": f"{results['mean_local_us']:.1f}",
+    })
+    return results
+
+# Function to measure how long a fresh interpreter takes to import the project modules
+def bench_startup(modules=("project", "server"), runs=10, top=8):
+    """
+    Starts fresh interpreters that import each module, without an API key in the environment, and
+    reports the median import cost over an empty interpreter plus the heaviest imports from -X importtime.
+
+    Args:
+        modules (tuple): The modules to import.
+        runs (int): How many fresh interpreters to start per module.
+        top (int): How many of the heaviest imports to list per module.
+
+    Returns:
+        dict: The median import time in milliseconds for each module.
+    """
+    env = {name: value for name, value in os.environ.items() if name != "OPENAI_API_KEY"}
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def median_ms(code):
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], env=env, cwd=cwd, check=True)
+            durations.append((time.perf_counter() - start) * 1000)
+        return statistics.median(durations)
+
+    def importtime(code):
+        return parse_importtime(subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            env=env, cwd=cwd, check=True, capture_output=True, text=True,
+        ).stderr)
+
+    baseline = median_ms("pass")
+    baseline_imports = importtime("pass")
+    results = {}
+    for module in modules:
+        results[module] = median_ms(f"import {module}") - baseline
+        imports = importtime(f"import {module}")
+
+        rows = {
+            "Median import (ms)": f"{results[module]:.1f}",
+            "Interpreter baseline (ms)": f"{baseline:.1f}",
+        }
+        heaviest = sorted(imports.items(), key=lambda item: item[1], reverse=True)
+        # Imports an empty interpreter already pays for, like site, are not the module's cost
+        heaviest = [item for item in heaviest if item[0] != module and item[0] not in baseline_imports]
+        for name, cumulative_us in heaviest[:top]:
+            rows[f"  {name} (ms)"] = f"{cumulative_us / 1000:.1f}"
+        print_results(f"Startup: import {module}", rows)
+    return results
+
+# Function to read the cumulative time of each top-level import from -X importtime output
+def parse_importtime(output):
+    '''Return a dict of cumulative microseconds for the top-level modules and their direct imports in -X importtime output'''
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented two spaces per level, keep the module and its direct imports
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level <= 1:
+            imports[name.strip()] = imports.get(name.strip(), 0) + int(cumulative)
+    return imports
+
+# Function to run scripted conversations through main() against the mock OpenAI backend
+def bench_sessions(concurrency=(1, 4, 16), sessions=32, turns=5, latency=0.3, token_latency=0.01, cache=False, fault_rate=0.0, typing=0.0):
+    """
+    Drives complete sessions through main() and have_conversation() with a scripted console and the
+    mock OpenAI client, and reports round-trips per turn, turn latency and sessions per second.
+
+    Args:
+        concurrency (list): The numbers of concurrent sessions to measure.
+        sessions (int): How many sessions are run at each concurrency level.
+        turns (int): How many messages the user sends in each session.
+        latency (float): Mock seconds before a response or its first streamed token.
+        token_latency (float): Mock seconds between streamed tokens.
+        cache (bool): Keep the validation cache enabled.
+        fault_rate (float): The chance of an injected fault per request, which request_scheduler has to recover from.
+        typing (float): Seconds the scripted user takes to type each answer, which the startup checks can overlap with.
+
+    Returns:
+        dict: The measurements for each concurrency level.
+    """
+    from mock_openai import FaultyOpenAI
+
+    client = FaultyOpenAI(fault_rate=fault_rate, slow_latency=latency * 10, latency=latency, token_latency=token_latency)
+    console = ScriptedConsole(typing_delay=typing)
+    script = ["Harry Potter", "Hermione", "in the library"]
+    script += [f"Tell me something about your week, part {turn}." for turn in range(1, turns + 1)]
+    script += ["quit"]
+
+    previous = (project._client, project._console, project.transcript_store, project.VALIDATION_CACHE_ENABLED,
+                project.REQUEST_TIMEOUT, project.VALIDATION_TIMEOUT)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        project.set_client(client)
+        project.set_console(console)
+        project.transcript_store = project.TranscriptStore(directory)
+        project.VALIDATION_CACHE_ENABLED = cache
+        # Timeouts scaled to the mock, so injected timeouts and slow answers cost seconds rather than a minute
+        project.REQUEST_TIMEOUT = project.VALIDATION_TIMEOUT = latency * 5 + 1
+        try:
+            for level in concurrency:
+                client.reset()
+                console.reset()
+                start = time.perf_counter()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=level) as executor:
+                    list(executor.map(lambda _: run_scripted_session(console, script), range(sessions)))
+                elapsed = time.perf_counter() - start
+
+                turn_latencies = console.turn_latencies
+                conversation_calls = [call for call in client.calls if not call['messages'][0]['content'].startswith("You are an expert")]
+                results[level] = {
+                    'sessions_per_second': sessions / elapsed,
+                    'turns': len(turn_latencies),
+                    'round_trips_per_turn': len(conversation_calls) / max(1, len(turn_latencies)),
+                    'p50_turn_ms': percentile(turn_latencies, 0.5) * 1000,
+                    'p99_turn_ms': percentile(turn_latencies, 0.99) * 1000,
+                    'p50_startup_ms': percentile(console.startup_latencies, 0.5) * 1000,
+                }
+        finally:
+            project.set_client(previous[0])
+            project.set_console(previous[1])
+            project.transcript_store = previous[2]
+            project.VALIDATION_CACHE_ENABLED = previous[3]
+            project.REQUEST_TIMEOUT, project.VALIDATION_TIMEOUT = previous[4], previous[5]
+
+    results_table = Table(title="Scripted sessions against the mock backend", box=box.SIMPLE)
+    for column in ("Concurrent", "Sessions/s", "Turns", "Calls/turn", "p50 turn ms", "p99 turn ms", "Startup ms"):
+        results_table.add_column(column, justify="right")
+    for level, result in results.items():
+        results_table.add_row(str(level), f"{result['sessions_per_second']:.2f}", str(result['turns']),
+                              f"{result['round_trips_per_turn']:.2f}", f"{result['p50_turn_ms']:.0f}",
+                              f"{result['p99_turn_ms']:.0f}", f"{result['p50_startup_ms']:.0f}")
+    rich_print(results_table)
+    rich_print(f"mock latency {latency * 1000:.0f} ms, {token_latency * 1000:.0f} ms per token, "
+               f"{sessions} sessions of {turns} turns per level, validation cache {'on' if cache else 'off'}, "
+               f"{fault_rate:.0%} of requests faulty, {typing * 1000:.0f} ms typing per answer")
+    return results
+
+# Function to compare the two ways of detecting the end of the conversation
+def bench_end_detection(live=False, turns=None, latency=0.3, token_latency=0.01, local_threshold=project.LOCAL_GOODBYE_THRESHOLD):
+    """
+    Runs the same user messages with END_DETECTION "separate" (reply, then goodbye check) and "tool" (reply and
+    end signal in one request), and reports API requests per turn, per-turn latency and, when live, how often
+    the tool's end signal agrees with the prompt-based goodbye check on the same reply. The mock derives both
+    from the local classifier, so their agreement is only measured live.
+
+    Args:
+        live (bool): Talk to OpenAI instead of the mock backend.
+        turns (int): How many messages are sent in each mode, one per goodbye fixture (10 when live) if None.
+        latency (float): Mock seconds before a response or its first streamed token.
+        token_latency (float): Mock seconds between streamed tokens.
+        local_threshold (float): The local classifier threshold of the separate goodbye check, None to always ask OpenAI.
+
+    Returns:
+        dict: The measurements for each mode, plus the agreement of the end signals (None unless live).
+    """
+    import io
+
+    fixtures = load_goodbye_fixtures()
+    if turns is None:
+        turns = 10 if live else len(fixtures)
+    # The mock replies with the fixtures in turn, so goodbyes of every kind come up
+    conversation = project.initialize_conversation("Harry Potter", "Hermione", "in the Gryffindor common room")
+    messages = [f"Tell me something about your week, part {turn}." for turn in range(1, turns + 1)]
+
+    previous = (project._client, project._console, project.call_metrics, project.VALIDATION_CACHE_ENABLED, project.STREAM_RESPONSES)
+    results = {}
+    agreements = []
+    try:
+        if not live:
+            from mock_openai import MockOpenAI
+
+            project.set_client(MockOpenAI(replies=[fixture["response"] for fixture in fixtures], latency=latency, token_latency=token_latency))
+        project.set_console(Console(file=io.StringIO()))
+        project.VALIDATION_CACHE_ENABLED = False
+        project.STREAM_RESPONSES = True
+
+        for mode in ("separate", "tool"):
+            metrics = project.CallMetrics()
+            project.call_metrics = metrics
+            turn_latencies = []
+            for turn, message in enumerate(messages):
+                # Every turn gets a fresh conversation of the same length, so a goodbye doesn't end the run
+                history = conversation + [{'role': role, 'content': "..."} for _ in range(turn) for role in ("user", "assistant")]
+                request_messages = history + [{'role': 'user', 'content': message}]
+                start = time.perf_counter()
+                response, _, end_signal = project.conversation_turn(request_messages, "Hermione", "female", end_detection=mode)
+                if end_signal is None:
+                    project.check_for_goodbye(response, local_threshold=local_threshold)
+                turn_latencies.append(time.perf_counter() - start)
+
+                if live and end_signal is not None:
+                    # The reference is the prompt-based check on the very same reply, left out of the timings
+                    reference_metrics = project.call_metrics
+                    project.call_metrics = project.CallMetrics()
+                    agreements.append(end_signal == project.check_for_goodbye(response, local_threshold=None))
+                    project.call_metrics = reference_metrics
+
+            results[mode] = {
+                'requests_per_turn': sum(row['calls'] for row in metrics.summary()) / len(messages),
+                'mean_turn_ms': statistics.mean(turn_latencies) * 1000,
+                'p50_turn_ms': percentile(turn_latencies, 0.5) * 1000,
+                'p95_turn_ms': percentile(turn_latencies, 0.95) * 1000,
+            }
+    finally:
+        project.set_client(previous[0])
+        project.set_console(previous[1])
+        project.call_metrics = previous[2]
+        project.VALIDATION_CACHE_ENABLED = previous[3]
+        project.STREAM_RESPONSES = previous[4]
+    results['agreement'] = sum(agreements) / len(agreements) if agreements else None
+
+    results_table = Table(title="End of conversation detection", box=box.SIMPLE)
+    for column in ("Mode", "Requests/turn", "Mean turn ms", "p50 turn ms", "p95 turn ms"):
+        results_table.add_column(column, justify="right")
+    for mode in ("separate", "tool"):
+        result = results[mode]
+        results_table.add_row(mode, f"{result['requests_per_turn']:.2f}", f"{result['mean_turn_ms']:.0f}",
+                              f"{result['p50_turn_ms']:.0f}", f"{result['p95_turn_ms']:.0f}")
+    rich_print(results_table)
+    if results['agreement'] is None:
+        agreement = "agreement of the tool signal with the goodbye check is only measured with --live"
+    else:
+        agreement = f"tool signal agrees with the goodbye check on {results['agreement']:.0%} of replies"
+    rich_print(f"{'OpenAI' if live else f'mock latency {latency * 1000:.0f} ms'}, {len(messages)} turns per mode, "
+               f"local goodbye threshold {local_threshold}, {agreement}")
+    return results
+
+# Function to measure how the transcript memory index scales
+def bench_memory(transcripts=20000, exchanges=6, queries=200, seed=0):
+    """
+    Indexes synthetic transcripts of one character, then reports the indexing rate, the size of the index, the
+    query and recall latency at that size and how long the sync after a few newly saved transcripts takes.
+
+    Args:
+        transcripts (int): The number of transcripts indexed.
+        exchanges (int): The number of exchanges per transcript.
+        queries (int): The number of queries timed.
+        seed (int): The seed of the synthetic text.
+
+    Returns:
+        dict: The measurements.
+    """
+    import itertools
+    import random
+
+    import memory
+
+    generator = random.Random(seed)
+    # Made-up words with a Zipf-like distribution, so a few are very common and most are rare, like real text
+    syllables = ["ba", "ko", "ri", "sa", "tu", "len", "mor", "qui", "dra", "fel", "gon", "hi", "ja", "wex", "zor"]
+    vocabulary = ["".join(generator.choice(syllables) for _ in range(generator.randint(2, 4))) for _ in range(20000)]
+    cumulative_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+
+    def sentence(words):
+        return " ".join(generator.choices(vocabulary, cum_weights=cumulative_weights, k=words)).capitalize() + "."
+
+    corpus = [[(sentence(12), sentence(30)) for _ in range(exchanges)] for _ in range(transcripts)]
+    with tempfile.TemporaryDirectory() as directory:
+        index = memory.MemoryIndex(os.path.join(directory, "memory.sqlite3"), count_tokens=project.count_tokens)
+        start = time.perf_counter()
+        for session_id, session_exchanges in enumerate(corpus, start=1):
+            index.add_session("Harry Potter", "Hermione", session_id, session_exchanges)
+        build_seconds = time.perf_counter() - start
+
+        query_latencies = []
+        recall_latencies = []
+        for _ in range(queries):
+            query = sentence(12)
+            start = time.perf_counter()
+            index.search("Harry Potter", "Hermione", query)
+            query_latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            index.recall("Harry Potter", "Hermione", query, project.MEMORY_TOKEN_BUDGET, project.MEMORY_MAX_EXCHANGES)
+            recall_latencies.append(time.perf_counter() - start)
+
+        # Incremental sync: only the transcripts saved since the last sync are read and indexed. They belong to
+        # another character, the synthetic sessions above are not in the store and would be forgotten by a sync
+        store = project.TranscriptStore(directory)
+        for _ in range(10):
+            transcript = store.create_session("Ron", "male", source_material="Harry Potter")
+            for _ in range(exchanges):
+                transcript.append({'role': 'user', 'content': sentence(12)})
+                transcript.append({'role': 'assistant', 'content': sentence(30)})
+            transcript.close()
+        start = time.perf_counter()
+        synced = index.sync(store, "Harry Potter", "Ron")
+        sync_seconds = time.perf_counter() - start
+        index.close()
+        size_mb = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                      if name.startswith("memory.sqlite3")) / 1_000_000
+
+    results = {
+        'exchanges': transcripts * exchanges,
+        'build_seconds': build_seconds,
+        'exchanges_per_second': transcripts * exchanges / build_seconds,
+        'index_mb': size_mb,
+        'p50_query_ms': percentile(query_latencies, 0.5) * 1000,
+        'p95_query_ms': percentile(query_latencies, 0.95) * 1000,
+        'p50_recall_ms': percentile(recall_latencies, 0.5) * 1000,
+        'p95_recall_ms': percentile(recall_latencies, 0.95) * 1000,
+        'sync_ms_per_transcript': sync_seconds / max(1, synced) * 1000,
+    }
+    print_results("Transcript memory index", {
+        "Transcripts": f"{transcripts:,}",
+        "Exchanges": f"{results['exchanges']:,}",
+        "Build (s)": f"{results['build_seconds']:.1f}",
+        "Exchanges indexed/s": f"{results['exchanges_per_second']:,.0f}",
+        "Index size (MB)": f"{results['index_mb']:.1f}",
+        "Query p50 / p95 (ms)": f"{results['p50_query_ms']:.1f} / {results['p95_query_ms']:.1f}",
+        "Recall p50 / p95 (ms)": f"{results['p50_recall_ms']:.1f} / {results['p95_recall_ms']:.1f}",
+        "Sync per new transcript (ms)": f"{results['sync_ms_per_transcript']:.1f}",
+    })
+    return results
+
+# Function to measure how much of every kind of prompt is the same from call to call
+def bench_prompts():
+    """
+    Builds the requests of every kind of call for a few different sessions and reports, per kind, the
+    prompt tokens and the tokens at the start that every one of those requests shares. Providers that
+    cache prompt prefixes can only reuse that shared part. Tokens are counted locally.
+
+    Returns:
+        dict: The average prompt tokens, the shared prefix tokens and their ratio for each kind of call.
+    """
+    sessions = [
+        ("Harry Potter", "Hermione", "in the Gryffindor common room"),
+        ("The Lord of the Rings", "Samwise", "at the Prancing Pony, late at night"),
+        ("Pride and Prejudice", "Elizabeth", ""),
+        ("Sherlock Holmes", "Watson", "221B Baker Street, a rainy afternoon"),
+    ]
+    replies = [fixture["response"] for fixture in load_goodbye_fixtures()[:len(sessions)]]
+    exchanges = [[{'role': 'user', 'content': f"What did you do {when}?"}, {'role': 'assistant', 'content': reply}]
+                 for when, reply in zip(["today", "last week", "this morning", "yesterday"], replies)]
+    requests = {
+        'conversation': [project.initialize_conversation(source_material, character, setting) + [{'role': 'user', 'content': "Hello there!"}]
+                         for source_material, character, setting in sessions],
+        'existence_check': [project.existence_check_messages(source_material, character) for source_material, character, _ in sessions],
+        'batch_existence_check': [project.batch_existence_check_messages([pair[:2] for pair in sessions[start:] + sessions[:start]][:2])
+                                  for start in range(len(sessions))],
+        'goodbye_check': [project.goodbye_check_messages(reply) for reply in replies],
+        'summary': [project.summary_request_messages("", exchange, character) for exchange, (_, character, _) in zip(exchanges, sessions)],
+    }
+
+    results = {}
+    for name, kind_requests in requests.items():
+        # The request as the model reads it, so the shared part can be measured in tokens
+        texts = ["".join(f"<{message['role']}>{message['content']}" for message in messages) for messages in kind_requests]
+        prompt_tokens = statistics.mean(project.count_message_tokens(messages) for messages in kind_requests)
+        prefix_tokens = project.count_tokens(os.path.commonprefix(texts))
+        results[name] = {
+            'prompt_tokens': prompt_tokens,
+            'prefix_tokens': prefix_tokens,
+            'prefix_ratio': prefix_tokens / prompt_tokens,
+        }
+
+    results_table = Table(title="Shared prompt prefix per kind of call", box=box.SIMPLE)
+    results_table.add_column("Call")
+    results_table.add_column("Prompt tokens", justify="right")
+    results_table.add_column("Shared prefix tokens", justify="right")
+    results_table.add_column("Shared", justify="right")
+    for name, result in results.items():
+        results_table.add_row(name, f"{result['prompt_tokens']:.0f}", f"{result['prefix_tokens']}", f"{result['prefix_ratio']:.0%}")
+    rich_print(results_table)
+    return results
+
+# Function to run one session through main() with a scripted console
+def run_scripted_session(console, script):
+    '''Run main() until the session exits, answering its prompts from script'''
+    console.start(script)
+    try:
+        project.main()
+    except SystemExit:
+        pass
+    console.finish()
+
+# Rich console that answers input prompts from a per-thread script
+class ScriptedConsole(Console):
+    """
+    A Rich console that discards its output and answers each input prompt with the next line of the
+    script of the calling thread, declining to resume sessions. The time from answering a message
+    to the next "You:" prompt is recorded as a turn, the time from the last setup answer to the first
+    "You:" prompt as startup.
+
+    Args:
+        typing_delay (float): Seconds the user takes to type each answer.
+        save (bool): Save every transcript at the end of the session instead of discarding it.
+    """
+    def __init__(self, typing_delay=0.0, save=False):
+        super().__init__(file=open(os.devnull, "w"), width=100)
+        self.typing_delay = typing_delay
+        self.save = save
+        self.local = threading.local()
+        self.turn_latencies = []
+        self.startup_latencies = []
+        self._latency_lock = threading.Lock()
+
+    def reset(self):
+        '''Forget the recorded latencies'''
+        with self._latency_lock:
+            self.turn_latencies = []
+            self.startup_latencies = []
+
+    def start(self, script):
+        '''Start answering prompts in this thread from script'''
+        self.local.script = iter(script)
+        self.local.answered_at = None
+        self.local.in_conversation = False
+        self.local.save_prompt = False
+
+    def finish(self):
+        '''Stop answering prompts in this thread'''
+        self.local.script = iter(())
+
+    def print(self, *objects, **kwargs):
+        # The save question comes before a "You:" prompt that is not a conversation turn
+        if any("Do you want to save" in str(item) for item in objects):
+            self.local.save_prompt = True
+        super().print(*objects, **kwargs)
+
+    def input(self, prompt="", **kwargs):
+        now = time.perf_counter()
+        prompt = str(prompt)
+        if getattr(self.local, "save_prompt", False):
+            # Discard every transcript unless asked to save, so every session does the same work
+            self.local.save_prompt = False
+            return "y" if self.save else "n"
+        if "Resume" in prompt:
+            # Never resume old sessions, for the same reason
+            return "n"
+
+        if "You:" in prompt and self.local.answered_at is not None:
+            with self._latency_lock:
+                if self.local.in_conversation:
+                    self.turn_latencies.append(now - self.local.answered_at)
+                else:
+                    self.startup_latencies.append(now - self.local.answered_at)
+        self.local.in_conversation = "You:" in prompt
+
+        answer = next(self.local.script, "quit")
+        time.sleep(self.typing_delay)
+        self.local.answered_at = time.perf_counter()
+        return answer
+
+# Function to find a percentile of a list of values
+def percentile(values, fraction):
+    '''Return the value below which the given fraction of values fall, using the nearest rank'''
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+# Function to print a two-column table of benchmark results
+def print_results(title, rows):
+    '''Print the benchmark title and its name/value rows as a table'''
+    results_table = Table(title=title, box=box.SIMPLE)
+    results_table.add_column("Metric")
+    results_table.add_column("Value", justify="right")
+    for name, value in rows.items():
+        results_table.add_row(name, value)
+    rich_print(results_table)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import collections
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1=1.2
+BM25_B=0.75
+
+# document ids looked up per query when only the exchanges still in the running are scored
+LOOKUP_CHUNK_SIZE=500
+
+# version of SCHEMA, an index built with an older one is dropped and rebuilt from the transcripts
+SCHEMA_VERSION=2
+
+TERM_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+    a about after again all am an and any are as at be because been before being but by can could did do does doing
+    don down for from had has have having he her here hers him his how i if in into is it its just me more most my no
+    nor not now of off on once only or other our ours out over own s same she should so some such t than that the their
+    them then there these they this those through to too under until up very was we were what when where which while
+    who whom why will with would you your yours ll re ve d m
+""".split())
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS characters (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    name TEXT NOT NULL,
+    documents INTEGER NOT NULL DEFAULT 0,
+    total_length INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (source, name)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    character_id INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    PRIMARY KEY (character_id, session)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    character_id INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    tokens INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_by_session ON documents (character_id, session, position);
+CREATE TABLE IF NOT EXISTS terms (
+    character_id INTEGER NOT NULL,
+    term TEXT NOT NULL,
+    documents INTEGER NOT NULL,
+    PRIMARY KEY (character_id, term)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS postings (
+    character_id INTEGER NOT NULL,
+    term TEXT NOT NULL,
+    document INTEGER NOT NULL,
+    frequency INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (character_id, term, document)
+) WITHOUT ROWID;
+"""
+
+
+# Function to turn a source material into the key it is indexed under
+def source_key(source_material):
+    '''Return source_material in lowercase, without punctuation and with single spaces'''
+    return " ".join(re.sub(r"[^\w\s]", " ", source_material).casefold().split())
+
+# Function to split text into the terms that are indexed
+def tokenize(text):
+    '''Return the lowercase words of text, leaving out stopwords'''
+    return [term for term in TERM_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+# Function to read the exchanges of a saved transcript
+def transcript_exchanges(path):
+    '''Return the (user message, reply) pairs of a JSONL transcript in order, a message without a reply is left out'''
+    exchanges = []
+    user_message = None
+    with open(path, encoding="utf-8") as transcript_file:
+        for line in transcript_file:
+            record = json.loads(line)
+            if record.get('type') != 'message':
+                continue
+            if record['role'] == 'user':
+                user_message = record['content']
+            elif record['role'] == 'assistant' and user_message is not None:
+                exchanges.append((user_message, record['content']))
+                user_message = None
+    return exchanges
+
+# Function to count tokens when the index is not given a tokenizer
+def estimate_tokens(text):
+    '''Return the number of tokens in text, estimated at four characters per token'''
+    return (len(text) + 3) // 4
+
+# On-disk BM25 index of the exchanges in saved transcripts
+class MemoryIndex:
+    """
+    An inverted index in a SQLite file over every exchange (a user message and the character's reply) of
+    the saved transcripts, kept per character of a source material. Sessions are added and removed one at a time, so keeping
+    the index up to date only costs the sessions saved since the last sync.
+
+    Args:
+        path (str): The SQLite file, created if needed.
+        count_tokens (callable): Returns the number of tokens in a text, used to keep recalled exchanges within a budget.
+    """
+    def __init__(self, path, count_tokens=None):
+        self.path = path
+        self.count_tokens = estimate_tokens if count_tokens is None else count_tokens
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Older indexes kept characters by name only, they are rebuilt by the next sync
+            for table in ("characters", "sessions", "documents", "terms", "postings"):
+                self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def add_session(self, source_material, character, session_id, exchanges):
+        """
+        Indexes the exchanges of one session, unless the session is already indexed.
+
+        Args:
+            source_material (str): The source material the character is from.
+            character (str): The character's name.
+            session_id (int): The id of the session in the TranscriptStore.
+            exchanges (list): (user message, reply) pairs.
+
+        Returns:
+            int: The number of exchanges indexed.
+        """
+        with self._lock, self._connection:
+            character_id = self._character_id(source_material, character)
+            if self._connection.execute("SELECT 1 FROM sessions WHERE character_id = ? AND session = ?",
+                                        (character_id, session_id)).fetchone():
+                return 0
+            self._connection.execute("INSERT INTO sessions (character_id, session) VALUES (?, ?)", (character_id, session_id))
+
+            total_length = 0
+            postings = []
+            term_documents = collections.Counter()
+            for position, (user_message, reply) in enumerate(exchanges):
+                terms = collections.Counter(tokenize(f"{user_message} {reply}"))
+                term_documents.update(terms.keys())
+                length = sum(terms.values())
+                tokens = self.count_tokens(f"{user_message}\n{reply}")
+                document = self._connection.execute(
+                    "INSERT INTO documents (character_id, session, position, user, reply, length, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (character_id, session_id, position, user_message, reply, length, tokens),
+                ).lastrowid
+                postings += [(character_id, term, document, frequency, length) for term, frequency in terms.items()]
+                total_length += length
+            self._connection.executemany(
+                "INSERT INTO postings (character_id, term, document, frequency, length) VALUES (?, ?, ?, ?, ?)", postings
+            )
+            self._connection.executemany(
+                "INSERT INTO terms (character_id, term, documents) VALUES (?, ?, ?) "
+                "ON CONFLICT (character_id, term) DO UPDATE SET documents = documents + excluded.documents",
+                [(character_id, term, count) for term, count in term_documents.items()],
+            )
+            self._connection.execute("UPDATE characters SET documents = documents + ?, total_length = total_length + ? WHERE id = ?",
+                                     (len(exchanges), total_length, character_id))
+        return len(exchanges)
+
+    def remove_session(self, source_material, character, session_id):
+        '''Forget the exchanges of one session'''
+        with self._lock, self._connection:
+            character_id = self._character_id(source_material, character)
+            documents = self._connection.execute(
+                "SELECT id, user, reply, length FROM documents WHERE character_id = ? AND session = ?", (character_id, session_id)
+            ).fetchall()
+            # The terms of a document are found again by tokenizing it, so postings need no index by document
+            document_terms = [(document, set(tokenize(f"{user_message} {reply}"))) for document, user_message, reply, _ in documents]
+            self._connection.executemany(
+                "DELETE FROM postings WHERE character_id = ? AND term = ? AND document = ?",
+                [(character_id, term, document) for document, terms in document_terms for term in terms],
+            )
+            term_documents = collections.Counter(term for _, terms in document_terms for term in terms)
+            self._connection.executemany(
+                "UPDATE terms SET documents = documents - ? WHERE character_id = ? AND term = ?",
+                [(count, character_id, term) for term, count in term_documents.items()],
+            )
+            self._connection.executemany("DELETE FROM terms WHERE character_id = ? AND term = ? AND documents <= 0",
+                                         [(character_id, term) for term in term_documents])
+            self._connection.execute("DELETE FROM documents WHERE character_id = ? AND session = ?", (character_id, session_id))
+            self._connection.execute("DELETE FROM sessions WHERE character_id = ? AND session = ?", (character_id, session_id))
+            self._connection.execute("UPDATE characters SET documents = documents - ?, total_length = total_length - ? WHERE id = ?",
+                                     (len(documents), sum(document[3] for document in documents), character_id))
+
+    def sync(self, store, source_material, character):
+        """
+        Brings the character's part of the index up to date with a TranscriptStore: closed sessions that are
+        not indexed yet are added and sessions that were removed from the store are forgotten. A session that
+        is still open, like the one of the running conversation, is left for a later sync.
+
+        Args:
+            store (TranscriptStore): The store holding the transcripts.
+            source_material (str): The source material the character is from.
+            character (str): The character's name.
+
+        Returns:
+            int: The number of sessions added.
+        """
+        saved = {session['id']: session['filename'] for session in store.list_sessions(character, source_material) if session['closed']}
+        with self._lock:
+            indexed = {row[0] for row in self._connection.execute(
+                "SELECT session FROM sessions JOIN characters ON characters.id = sessions.character_id "
+                "WHERE characters.source = ? AND characters.name = ?", (source_key(source_material), character),
+            )}
+
+        for session_id in indexed - saved.keys():
+            self.remove_session(source_material, character, session_id)
+        added = 0
+        for session_id in sorted(saved.keys() - indexed):
+            path = os.path.join(store.directory, saved[session_id])
+            try:
+                exchanges = transcript_exchanges(path)
+            except (OSError, ValueError):
+                # A transcript that was deleted by hand or can't be read is picked up next time, if at all
+                continue
+            self.add_session(source_material, character, session_id, exchanges)
+            added += 1
+        return added
+
+    def search(self, source_material, character, query, limit=10):
+        """
+        Ranks the character's past exchanges against the query with BM25.
+
+        Args:
+            source_material (str): The source material the character is from.
+            character (str): The character's name.
+            query (str): The text to find relevant exchanges for.
+            limit (int): The maximum number of exchanges returned.
+
+        Returns:
+            list: Dicts with the 'session', 'position', 'user', 'reply', 'tokens' and 'score' of each exchange, best first.
+        """
+        terms = collections.Counter(tokenize(query))
+        with self._lock:
+            row = self._connection.execute("SELECT id, documents, total_length FROM characters WHERE source = ? AND name = ?",
+                                           (source_key(source_material), character)).fetchone()
+            if row is None or not row[1] or not terms:
+                return []
+            character_id, documents, total_length = row
+            average_length = total_length / documents
+
+            # Rare terms first. Once the terms left can't lift an unseen exchange into the results, the common terms,
+            # which have the longest posting lists, are only looked up for the exchanges that are still in the running
+            weighted_terms = []
+            for term, query_frequency in terms.items():
+                row = self._connection.execute("SELECT documents FROM terms WHERE character_id = ? AND term = ?", (character_id, term)).fetchone()
+                if row is None:
+                    continue
+                idf = math.log(1 + (documents - row[0] + 0.5) / (row[0] + 0.5))
+                weighted_terms.append((query_frequency * idf * (BM25_K1 + 1), term, query_frequency * idf))
+            weighted_terms.sort(reverse=True)
+
+            scores = {}
+            remaining = sum(upper_bound for upper_bound, _, _ in weighted_terms)
+            for upper_bound, term, weight in weighted_terms:
+                threshold = heapq.nlargest(limit, scores.values())[-1] if len(scores) >= limit else 0.0
+                if remaining > threshold:
+                    postings = self._connection.execute(
+                        "SELECT document, frequency, length FROM postings WHERE character_id = ? AND term = ?", (character_id, term)
+                    ).fetchall()
+                else:
+                    candidates = [document for document, score in scores.items() if score + remaining > threshold]
+                    if not candidates:
+                        break
+                    postings = []
+                    for start in range(0, len(candidates), LOOKUP_CHUNK_SIZE):
+                        chunk = candidates[start:start + LOOKUP_CHUNK_SIZE]
+                        postings += self._connection.execute(
+                            "SELECT document, frequency, length FROM postings WHERE character_id = ? AND term = ? "
+                            f"AND document IN ({', '.join('?' * len(chunk))})", (character_id, term, *chunk)
+                        ).fetchall()
+                remaining -= upper_bound
+
+                for document, frequency, length in postings:
+                    normalization = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                    scores[document] = scores.get(document, 0.0) + weight * frequency * (BM25_K1 + 1) / (frequency + normalization)
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [dict(self._document(document), score=score) for document, score in best]
+
+    def recent(self, source_material, character, limit=10):
+        '''Return the character's most recent exchanges, newest first, in the format of search'''
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT documents.id FROM documents JOIN characters ON characters.id = documents.character_id "
+                "WHERE characters.source = ? AND characters.name = ? ORDER BY session DESC, position DESC LIMIT ?",
+                (source_key(source_material), character, limit)
+            ).fetchall()
+            return [dict(self._document(row[0]), score=0.0) for row in rows]
+
+    def recall(self, source_material, character, query, token_budget, max_exchanges):
+        """
+        Picks the exchanges most relevant to the query that fit in the token budget, or the most recent ones
+        if nothing is relevant.
+
+        Args:
+            source_material (str): The source material the character is from.
+            character (str): The character's name.
+            query (str): The text to find relevant exchanges for, e.g. the user's message.
+            token_budget (int): The maximum number of tokens of the exchanges together.
+            max_exchanges (int): The maximum number of exchanges.
+
+        Returns:
+            list: The chosen exchanges in the order they happened.
+        """
+        candidates = (self.search(source_material, character, query, limit=max_exchanges * 4)
+                      or self.recent(source_material, character, limit=max_exchanges))
+        chosen = []
+        tokens = 0
+        for exchange in candidates:
+            if tokens + exchange['tokens'] > token_budget:
+                continue
+            chosen.append(exchange)
+            tokens += exchange['tokens']
+            if len(chosen) == max_exchanges:
+                break
+        return sorted(chosen, key=lambda exchange: (exchange['session'], exchange['position']))
+
+    def stats(self, source_material, character):
+        '''Return the number of indexed sessions and exchanges of the character from the source material'''
+        with self._lock:
+            row = self._connection.execute("SELECT id, documents FROM characters WHERE source = ? AND name = ?",
+                                           (source_key(source_material), character)).fetchone()
+            if row is None:
+                return {'sessions': 0, 'exchanges': 0}
+            sessions = self._connection.execute("SELECT COUNT(*) FROM sessions WHERE character_id = ?", (row[0],)).fetchone()[0]
+            return {'sessions': sessions, 'exchanges': row[1]}
+
+    def close(self):
+        '''Close the SQLite connection'''
+        self._connection.close()
+
+    def _character_id(self, source_material, character):
+        source = source_key(source_material)
+        row = self._connection.execute("SELECT id FROM characters WHERE source = ? AND name = ?", (source, character)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._connection.execute("INSERT INTO characters (source, name) VALUES (?, ?)", (source, character)).lastrowid
+
+    def _document(self, document):
+        session, position, user_message, reply, tokens = self._connection.execute(
+            "SELECT session, position, user, reply, tokens FROM documents WHERE id = ?", (document,)
+        ).fetchone()
+        return {'session': session, 'position': position, 'user': user_message, 'reply': reply, 'tokens': tokens}
+
+# What one conversation remembers of the earlier ones
+class CharacterMemory:
+    """
+    Gives a conversation the past exchanges with its character that are relevant to a query, as a system message.
+
+    Args:
+        index (MemoryIndex): The index of the saved transcripts.
+        source_material (str): The source material the character is from.
+        character (str): The character's name.
+        token_budget (int): The maximum number of tokens of remembered exchanges per request.
+        max_exchanges (int): The maximum number of remembered exchanges per request.
+        ready (Future): Resolved once the index is up to date, e.g. a background sync, waited for on first use.
+    """
+    def __init__(self, index, source_material, character, token_budget, max_exchanges, ready=None):
+        self.index = index
+        self.source_material = source_material
+        self.character = character
+        self.token_budget = token_budget
+        self.max_exchanges = max_exchanges
+        self.ready = ready
+
+    def message(self, query):
+        '''Return the system message with the exchanges relevant to query, None if there is nothing to remember'''
+        if self.ready is not None:
+            try:
+                self.ready.result()
+            except (OSError, sqlite3.Error):
+                # The index stays as it was, older memories are better than none
+                pass
+            self.ready = None
+        exchanges = self.index.recall(self.source_material, self.character, query, self.token_budget, self.max_exchanges)
+        if not exchanges:
+            return None
+        return memory_message(exchanges, self.character)
+
+# Function to build the system message that carries remembered exchanges
+def memory_message(exchanges, character):
+    '''Return the system message used to remind the character of exchanges from earlier conversations'''
+    remembered = "\n\n".join(f"User: {exchange['user']}\n{character}: {exchange['reply']}" for exchange in exchanges)
+    return {
+        'role': 'system',
+        'content': f'''Moments you remember from earlier conversations with this user, delimited by three backticks. '''
+                   f'''Bring them up only when they fit the conversation:\n```{remembered}```'''
+    }
@@ -0,0 +1,310 @@
+import asyncio
+import itertools
+import functools
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from openai.types import CompletionUsage, Model
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice, ChoiceDelta, ChoiceDeltaToolCall, ChoiceDeltaToolCallFunction
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+import project
+
+
+# characters the mock existence check knows about, keyed by (source material, character) in lowercase
+MOCK_CHARACTERS = {
+    ("harry potter", "harry"): "Harry male",
+    ("harry potter", "hermione"): "Hermione female",
+    ("harry potter", "ron"): "Ron male",
+    ("harry potter", "hedwig"): "Hedwig female",
+    ("sherlock holmes", "sherlock"): "Sherlock male",
+    ("the lord of the rings", "gandalf"): "Gandalf male",
+}
+
+# labeled replies, the mock goodbye check knows their labels like a model would
+GOODBYE_FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "goodbye_replies.json")
+
+# replies the mock character cycles through
+MOCK_REPLIES = [
+    "Hello! It's lovely to meet you. What brings you here today?",
+    "Oh, I've read all about that. It's far more complicated than most people think, you know.",
+    "Honestly, I'd rather talk about something else. Have you finished your homework?",
+    "That reminds me of something that happened last year. Would you like to hear about it?",
+    "Careful now. Some things are better left alone, and that is one of them.",
+    "It has been a pleasure talking with you. Until next time!",
+]
+
+# faults FaultyOpenAI can inject into a request
+FAULTS = ("rate_limit", "server_error", "timeout", "slow")
+
+EXISTENCE_QUESTION_PATTERN = re.compile(r"^(?P<number>\d+\. )?Is (?P<character>.+) a character in (?P<source>.+)\?$", re.MULTILINE)
+
+
+# Function to load the labels of the goodbye fixtures once
+@functools.lru_cache(maxsize=1)
+def goodbye_labels():
+    '''Return the label of every labeled reply, keyed by the reply'''
+    with open(GOODBYE_FIXTURES_PATH, encoding="utf-8") as fixtures_file:
+        return {fixture["response"]: fixture["label"] for fixture in json.load(fixtures_file)}
+
+# Function to answer the goodbye check the way the mock model does
+def goodbye_label(response):
+    '''Return the label of a labeled reply, so the mock never just echoes the local classifier, or its local label otherwise'''
+    label = goodbye_labels().get(response)
+    return label if label is not None else project.classify_goodbye_locally(response)[0]
+
+# Stand-in for openai.OpenAI that answers chat completions locally
+class MockOpenAI:
+    """
+    A client double with the same chat.completions.create interface as openai.OpenAI, including
+    streaming. Answers are scripted and every call is counted, so tests and benchmarks run offline.
+
+    Args:
+        replies (list): The conversation replies, the n-th reply of every conversation is replies[n], repeating.
+        characters (dict): The characters the existence check knows, see MOCK_CHARACTERS.
+        responder (callable): Called with (model, messages, **kwargs) to produce the reply text,
+            overriding the scripted answers. Return None to fall back to them.
+        latency (float): Seconds before a complete response, or before the first streamed token.
+        token_latency (float): Seconds between streamed tokens.
+        tool_call_only (bool): When a conversation request offers the end_conversation tool and the reply is a
+            goodbye, answer with nothing but the tool call instead of the reply and the tool call.
+    """
+    def __init__(self, replies=None, characters=None, responder=None, latency=0.0, token_latency=0.0, tool_call_only=False):
+        self.replies = list(replies or MOCK_REPLIES)
+        self.characters = MOCK_CHARACTERS if characters is None else characters
+        self.responder = responder
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tool_call_only = tool_call_only
+        self.calls = []
+        self.chat = _Chat(self)
+        self.models = _Models(self)
+        self.warmed_up = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def call_count(self):
+        return len(self.calls)
+
+    def reset(self):
+        '''Forget the recorded calls'''
+        with self._lock:
+            self.calls.clear()
+
+    def create(self, model, messages, stream=False, **kwargs):
+        '''Answer like client.chat.completions.create, sleeping for the configured latency'''
+        content = self._respond(model, messages, **kwargs)
+        content, tool_call = self._end_signal(content, kwargs.get('tools'))
+        if stream:
+            return self._stream(model, content, tool_call)
+        time.sleep(self.latency)
+        return self._completion(model, messages, content, tool_call)
+
+    def _stream(self, model, content, tool_call=None):
+        time.sleep(self.latency)
+        for chunk in self._chunks(model, content, tool_call):
+            yield chunk
+            time.sleep(self.token_latency)
+
+    def _respond(self, model, messages, **kwargs):
+        with self._lock:
+            self.calls.append({'model': model, 'messages': messages, **kwargs})
+        if self.responder is not None:
+            content = self.responder(model, messages, **kwargs)
+            if content is not None:
+                return content
+        return self.scripted_response(messages)
+
+    def scripted_response(self, messages):
+        '''Return the scripted answer for an existence check, goodbye check, summary or conversation request'''
+        system = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ""
+        last = messages[-1]['content'] if messages else ""
+
+        if system.startswith("You are an expert in fictional works"):
+            # Batches number their questions and expect numbered answers
+            answers = []
+            for question in EXISTENCE_QUESTION_PATTERN.finditer(last):
+                key = (question.group('source').strip().lower(), question.group('character').strip().lower())
+                answers.append((question.group('number') or "") + self.characters.get(key, "no"))
+            return "\n".join(answers) or "no"
+
+        if system.startswith("You are a scholar of language"):
+            return goodbye_label(last.strip("`"))
+
+        if system.startswith("You keep a running summary"):
+            return "They talked for a while about school, books and the weather."
+
+        # Every conversation walks through the script on its own, the turn is the number of replies so far
+        turn = sum(1 for message in messages if message['role'] == 'assistant')
+        return self.replies[turn % len(self.replies)]
+
+    def _end_signal(self, content, tools):
+        # A reply offered the end_conversation tool calls it when the reply is a goodbye
+        if not tools or not any(tool['function']['name'] == project.END_CONVERSATION_TOOL['function']['name'] for tool in tools):
+            return content, None
+        signal = goodbye_label(content)
+        if signal == "continue":
+            return content, None
+        arguments = {'signal': signal}
+        if self.tool_call_only:
+            arguments['farewell'] = content
+            content = None
+        return content, (project.END_CONVERSATION_TOOL['function']['name'], json.dumps(arguments))
+
+    def _completion(self, model, messages, content, tool_call=None):
+        prompt_tokens = project.count_message_tokens(messages, model)
+        completion_tokens = project.count_tokens((content or "") + (tool_call[1] if tool_call else ""), model)
+        tool_calls = None
+        if tool_call is not None:
+            tool_calls = [ChatCompletionMessageToolCall(id=f"call_mock_{next(self._ids)}", type="function",
+                                                        function=Function(name=tool_call[0], arguments=tool_call[1]))]
+        message = ChatCompletionMessage(role="assistant", content=content, tool_calls=tool_calls)
+        return ChatCompletion(
+            id=f"chatcmpl-mock-{next(self._ids)}",
+            choices=[Choice(finish_reason="tool_calls" if tool_calls else "stop", index=0, message=message)],
+            created=int(time.time()),
+            model=model,
+            object="chat.completion",
+            usage=CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens),
+        )
+
+    def _chunks(self, model, content, tool_call=None):
+        # Like the API, the text comes first, then the tool call's name and its arguments in pieces
+        for token in split_tokens(content) if content else []:
+            yield self._chunk(model, token)
+        if tool_call is not None:
+            name, arguments = tool_call
+            yield self._chunk(model, None, tool_call=ChoiceDeltaToolCall(
+                index=0, id=f"call_mock_{next(self._ids)}", type="function", function=ChoiceDeltaToolCallFunction(name=name, arguments="")))
+            for start in range(0, len(arguments), 8):
+                yield self._chunk(model, None, tool_call=ChoiceDeltaToolCall(
+                    index=0, function=ChoiceDeltaToolCallFunction(arguments=arguments[start:start + 8])))
+        yield self._chunk(model, None, finish_reason="tool_calls" if tool_call else "stop")
+
+    def _chunk(self, model, token, finish_reason=None, tool_call=None):
+        delta = ChoiceDelta(content=token, tool_calls=[tool_call] if tool_call is not None else None)
+        return ChatCompletionChunk(
+            id=f"chatcmpl-mock-{next(self._ids)}",
+            choices=[ChunkChoice(delta=delta, finish_reason=finish_reason, index=0)],
+            created=int(time.time()),
+            model=model,
+            object="chat.completion.chunk",
+        )
+
+# Stand-in for openai.AsyncOpenAI with the same scripted answers as MockOpenAI
+class AsyncMockOpenAI(MockOpenAI):
+    '''Async client double for the multi-session server, accepts the same arguments as MockOpenAI'''
+    async def create(self, model, messages, stream=False, **kwargs):
+        '''Answer like await client.chat.completions.create, sleeping for the configured latency'''
+        content = self._respond(model, messages, **kwargs)
+        content, tool_call = self._end_signal(content, kwargs.get('tools'))
+        await asyncio.sleep(self.latency)
+        if stream:
+            return self._async_stream(model, content, tool_call)
+        return self._completion(model, messages, content, tool_call)
+
+    async def _async_stream(self, model, content, tool_call=None):
+        for chunk in self._chunks(model, content, tool_call):
+            yield chunk
+            await asyncio.sleep(self.token_latency)
+
+# MockOpenAI that fails requests the way the OpenAI API does
+class FaultyOpenAI(MockOpenAI):
+    """
+    A MockOpenAI that injects rate limits, server errors, timeouts and slow answers, to test retries,
+    backoff, timeouts and hedging offline. The errors are the ones the openai package raises.
+
+    Args:
+        faults (list): The fault of each request in order, one of FAULTS or None for a normal answer.
+            Once they are used up, faults are drawn at random with fault_rate.
+        fault_rate (float): The chance of a random fault once the scripted faults are used up.
+        retry_after (float): The retry-after-ms header of rate limit errors in seconds, None to send none.
+        slow_latency (float): Seconds a 'slow' request takes. It times out if the request's timeout is shorter.
+        seed (int): The seed of the random faults.
+        **kwargs: Passed on to MockOpenAI.
+    """
+    def __init__(self, faults=(), fault_rate=0.0, retry_after=0.01, slow_latency=1.0, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.faults = list(faults)
+        self.fault_rate = fault_rate
+        self.retry_after = retry_after
+        self.slow_latency = slow_latency
+        self.injected = []
+        self._random = random.Random(seed)
+
+    def create(self, model, messages, stream=False, timeout=None, **kwargs):
+        '''Answer like MockOpenAI, unless this request gets a fault'''
+        fault = self.next_fault()
+        time.sleep(self._fault_delay(fault, timeout))
+        self._raise_fault(fault, timeout)
+        return super().create(model, messages, stream=stream, timeout=timeout, **kwargs)
+
+    def next_fault(self):
+        '''Return the fault of the next request and remember it in injected'''
+        with self._lock:
+            if self.faults:
+                fault = self.faults.pop(0)
+            elif self.fault_rate and self._random.random() < self.fault_rate:
+                fault = self._random.choice(FAULTS)
+            else:
+                fault = None
+            self.injected.append(fault)
+            return fault
+
+    def _fault_delay(self, fault, timeout):
+        # Slow requests and timeouts take until the request's timeout, slow ones at most slow_latency
+        if fault == "slow":
+            return self.slow_latency if timeout is None else min(self.slow_latency, timeout)
+        if fault == "timeout":
+            return timeout or 0.0
+        return 0.0
+
+    def _raise_fault(self, fault, timeout):
+        import httpx
+        import openai
+
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        if fault == "timeout" or (fault == "slow" and timeout is not None and timeout < self.slow_latency):
+            raise openai.APITimeoutError(request=request)
+        if fault == "rate_limit":
+            headers = {} if self.retry_after is None else {'retry-after-ms': str(int(self.retry_after * 1000))}
+            raise openai.RateLimitError("Rate limit reached for requests", response=httpx.Response(429, headers=headers, request=request), body=None)
+        if fault == "server_error":
+            raise openai.InternalServerError("The server had an error while processing your request", response=httpx.Response(500, request=request), body=None)
+
+# Async counterpart of FaultyOpenAI for the multi-session server
+class AsyncFaultyOpenAI(FaultyOpenAI, AsyncMockOpenAI):
+    '''Async client double that injects faults, accepts the same arguments as FaultyOpenAI'''
+    async def create(self, model, messages, stream=False, timeout=None, **kwargs):
+        '''Answer like AsyncMockOpenAI, unless this request gets a fault'''
+        fault = self.next_fault()
+        await asyncio.sleep(self._fault_delay(fault, timeout))
+        self._raise_fault(fault, timeout)
+        return await AsyncMockOpenAI.create(self, model, messages, stream=stream, timeout=timeout, **kwargs)
+
+class _Chat:
+    def __init__(self, client):
+        self.completions = client
+
+class _Models:
+    def __init__(self, client):
+        self.client = client
+
+    def retrieve(self, model, **kwargs):
+        # Used to warm up the connection, so it only costs the latency
+        time.sleep(self.client.latency)
+        with self.client._lock:
+            self.client.warmed_up += 1
+        return Model(id=model, created=int(time.time()), object="model", owned_by="openai")
+
+# Function to split text into token-sized pieces for streaming
+def split_tokens(text):
+    '''Split text into words with their leading whitespace, roughly the size of model tokens'''
+    return re.findall(r"\s*\S+", text) or [text]
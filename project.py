@@ -1,22 +1,23 @@
+import collections
+import contextlib
 import datetime
+import hashlib
+import json
 import os
+import random
+import re
+import threading
+import time
 
-from openai import OpenAI
-from dotenv import load_dotenv
-from rich import print as rich_print
-from rich.console import Console
-from rich import box
-from rich.table import Table
+import prompts
 
 
-# load environment variables
-load_dotenv()
-
-# create an instance of the OpenAI client
-client = OpenAI()
-
-# create an instance of the Rich console
-console = Console()
+# the OpenAI client and Rich console are created on first use, see get_client() and get_console()
+_client = None
+_console = None
+_client_lock = threading.Lock()
+_memory_indexes = {}
+_memory_lock = threading.Lock()
 
 # set the model used for the conversation
 CONVERSATION_MODEL="gpt-4"
@@ -24,31 +25,227 @@ VALIDATION_MODEL="gpt-3.5-turbo"
 CONVERSATION_TEMP=0.9
 VALIDATION_TEMP=0.0
 
+# stream the character's replies token-by-token and optionally show per-turn timings
+STREAM_RESPONSES=True
+SHOW_TURN_TIMINGS=False
+
+# how the end of the conversation is detected: "separate" runs the goodbye check after every reply,
+# "tool" lets the conversation call itself signal the end through END_CONVERSATION_TOOL
+END_DETECTION="separate"
+END_CONVERSATION_TOOL={
+    "type": "function",
+    "function": {
+        "name": "end_conversation",
+        "description": "Call this together with your reply when the reply ends the conversation: you say goodbye or leave, "
+                       "or the user made you too angry or uncomfortable to go on. Do not call it otherwise.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "signal": {
+                    "type": "string",
+                    "enum": ["goodbye", "angry goodbye"],
+                    "description": "'angry goodbye' if you leave because you are angry or upset, 'goodbye' otherwise.",
+                },
+                "farewell": {"type": "string", "description": "Your last words to the user."},
+            },
+            "required": ["signal"],
+        },
+    },
+}
+
+# on-disk cache for the temperature 0 existence and goodbye checks
+VALIDATION_CACHE_ENABLED=True
+VALIDATION_CACHE_PATH=os.path.join(".cache", "validation_cache.json")
+VALIDATION_CACHE_MAX_ENTRIES=2000
+VALIDATION_CACHE_TTL=60 * 60 * 24 * 30
+
+# replies the local goodbye classifier is at least this confident about never reach the API
+LOCAL_GOODBYE_THRESHOLD=0.85
+# seconds the goodbye check of a reply is waited for before the user is asked for the next message
+GOODBYE_CHECK_WAIT=1.0
+
+# maximum prompt tokens sent per conversation request, older turns are folded into a running summary
+CONTEXT_TOKEN_BUDGET=3000
+CONTEXT_MIN_RECENT_MESSAGES=4
+# maximum tokens of conversation folded into the summary per request, so a long resumed history fits VALIDATION_MODEL
+SUMMARY_CHUNK_TOKENS=2000
+
+# batch existence checks: pairs packed per request and concurrent requests
+BATCH_PACK_SIZE=8
+BATCH_MAX_CONCURRENCY=4
+BATCH_REQUESTS_PER_SECOND=None
+
+# timeouts, retries and rate limiting of every OpenAI request, see RequestScheduler
+REQUEST_TIMEOUT=60.0
+VALIDATION_TIMEOUT=15.0
+MAX_RETRIES=4
+RETRY_BASE_DELAY=0.5
+RETRY_MAX_DELAY=30.0
+REQUESTS_PER_SECOND=None
+REQUEST_BURST=5
+
+# validation requests still unanswered after this many seconds are sent a second time, the first answer wins (None disables it)
+VALIDATION_HEDGE_AFTER=None
+
+# per-call metrics: print a summary at session end and optionally export every call as JSONL or Prometheus text
+SHOW_CALL_METRICS=False
+METRICS_JSONL_PATH=None
+METRICS_PROMETHEUS_PATH=None
+METRICS_MAX_RECORDS=10000
+
+# dollars per 1K prompt and completion tokens, used to estimate the cost of every call
+MODEL_PRICES={
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+# where transcripts are stored and when records are written to disk ("none", "flush" or "fsync" after every record)
+TRANSCRIPT_DIR="conversations"
+TRANSCRIPT_FLUSH_POLICY="flush"
+# seconds after which the lock file of the transcript index is taken to be left by a crashed process
+TRANSCRIPT_LOCK_TIMEOUT=10.0
+
+# cross-session memory: the exchanges of saved conversations most relevant to the user's message are given to the character
+# on the first request of a conversation, and on every request with MEMORY_PER_TURN, within MEMORY_TOKEN_BUDGET tokens
+MEMORY_ENABLED=True
+MEMORY_INDEX_FILENAME="memory.sqlite3"
+MEMORY_TOKEN_BUDGET=400
+MEMORY_MAX_EXCHANGES=5
+MEMORY_PER_TURN=False
+
 def main():
     '''Main function to run the program'''
-    source_material, character, setting = greet_user()
+    if METRICS_JSONL_PATH:
+        call_metrics.add_hook(JsonlMetricsExporter(METRICS_JSONL_PATH))
 
-    source_check = check_character_existence(source_material, character)
+    # Connect to OpenAI while the user reads the greeting and starts typing
+    run_in_background(warm_up)
+    existence_check = {}
 
+    def start_existence_check(source_material, character):
+        # Check the character while the user is still typing the setting
+        existence_check['future'] = run_in_background(check_character_existence, source_material, character)
 
-    if source_check == 'no' or source_check == "no.":
-        rich_print(f"\n[bold red3]Sorry, {character} is not a character in {source_material.strip()}.[/]\n")
+    source_material, character, setting = greet_user(on_character=start_existence_check)
+    last_keystroke = time.perf_counter()
+
+    try:
+        source_check = existence_check['future'].result()
+    except api_errors() as error:
+        rich_print(f"\n[bold red3]Sorry, {character} couldn't be looked up: {describe_api_error(error)}.[/]\n")
         exit()
+    startup_wait = time.perf_counter() - last_keystroke
 
-    character_name = source_check.split(" ")[0].title()
-    gender = source_check.split(" ")[1]
+    character_check = parse_character_check(source_check)
+    if character_check is None:
+        rich_print(f"\n[bold red3]Sorry, {character} is not a character in {source_material.strip()}.[/]\n")
+        exit()
 
-    conversation = initialize_conversation(source_material, character_name, setting)
-    have_conversation(conversation, character_name, gender)
+    character_name, gender = character_check
+
+    # Offer to pick up the last saved conversation with this character
+    conversation = None
+    resumed_from = None
+    sessions = transcript_store.list_sessions(character_name, source_material)
+    if sessions:
+        resume = get_console().input(f"\n[bold]Resume your last conversation with {character_name}? ([green]y[/green]/[red]n[/red])[/] ")
+        if resume.lower() == 'y':
+            resumed_from = sessions[-1]['id']
+            conversation = transcript_store.load_session(character_name, resumed_from)
+
+    prompt_start = time.perf_counter()
+    if conversation is None:
+        conversation = initialize_conversation(source_material, character_name, setting)
+    startup_wait += time.perf_counter() - prompt_start
+    have_conversation(conversation, source_material, character_name, gender, resumed_from=resumed_from, startup_wait=startup_wait)
+
+# Function to run a function in a daemon thread
+def run_in_background(function, *args):
+    '''Start function(*args) in a daemon thread, which never holds up exiting, and return a Future of its result'''
+    import concurrent.futures
+
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except BaseException as error:
+            future.set_exception(error)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+# Function to open the connection to OpenAI and load the tokenizer before they are needed
+def warm_up():
+    '''Create the client and open a pooled connection with a cheap request, so the first real request skips TCP/TLS setup'''
+    count_tokens("")
+    client = get_client()
+    models = getattr(client, 'models', None)
+    if models is None:
+        return
+    try:
+        models.retrieve(CONVERSATION_MODEL, timeout=VALIDATION_TIMEOUT)
+    except Exception:
+        # Only a head start, the real requests will report any problem
+        pass
+
+# Function to get the OpenAI client, creating it on first use
+def get_client():
+    '''Return the shared OpenAI client, loading the environment variables and creating it if needed'''
+    global _client
+    # Startup creates the client from background threads, only one of them may do it
+    with _client_lock:
+        if _client is None:
+            from dotenv import load_dotenv
+            from openai import OpenAI
+
+            load_dotenv()
+            # Retries are done by request_scheduler, so the SDK must not retry on its own as well
+            _client = OpenAI(max_retries=0)
+        return _client
+
+# Function to replace the OpenAI client, e.g. with a preconfigured client or a test double
+def set_client(client):
+    '''Use client for every OpenAI call made by this module, None to go back to the default client'''
+    global _client
+    _client = client
+
+# Function to get the Rich console, creating it on first use
+def get_console():
+    '''Return the shared Rich console, creating it if needed'''
+    global _console
+    if _console is None:
+        from rich.console import Console
+
+        _console = Console()
+    return _console
+
+# Function to replace the Rich console, e.g. with one that records its output
+def set_console(console):
+    '''Use console for all input and output of this module, None to go back to the default console'''
+    global _console
+    _console = console
+
+# Function to print with Rich markup through the shared console
+def rich_print(*objects, **kwargs):
+    '''Print objects to the shared Rich console, accepts the same arguments as Console.print'''
+    get_console().print(*objects, **kwargs)
 
 # Function to greet user and collect initial information
-def greet_user():
+def greet_user(on_character=None):
     """
     Greets the user, collects information about the source material, character, and setting.
 
+    Args:
+        on_character (callable): Called with the source material and character as soon as both are
+            entered, before the user is asked for the setting.
+
     Returns:
         tuple: A tuple containing source material, character, and setting entered by the user.
     """
+    from rich import box
+    from rich.table import Table
+
     intro_table = Table(box=box.SQUARE_DOUBLE_HEAD)
     intro_table.add_column("Welcome to the Character Chat!", header_style="bold cyan", justify="center")
     intro_table.add_row('''This program allows you to have a conversation with your favorite characters from your favorite books, movies, and TV shows.\n\nTalk about anything you want, but be careful who you summon. Not all characters are friendly.\n\nTo get started, you'll just have to enter the name of the source material and the character you want to talk to.''')
@@ -59,9 +256,11 @@ def greet_user():
     rich_print("\n")
     rich_print(intro_table)
     
-    source_material = console.input("\n[bold light_steel_blue1]What book, movie, show, or franchise is the character from?[/] ").title()
-    character = console.input("\n[bold thistle3]What is the name of the character?[/] ").title()
-    setting = console.input("\n[bold grey78]Where/when does the conversation take place? Any other context?[/] [italic](optional)[/] ")
+    source_material = get_console().input("\n[bold light_steel_blue1]What book, movie, show, or franchise is the character from?[/] ").title()
+    character = get_console().input("\n[bold thistle3]What is the name of the character?[/] ").title()
+    if on_character is not None:
+        on_character(source_material, character)
+    setting = get_console().input("\n[bold grey78]Where/when does the conversation take place? Any other context?[/] [italic](optional)[/] ")
     rich_print("\n[italic]Type [encircle red]'quit'[/encircle red] to exit the program at any time.[italic/]")
 
     return source_material, character, setting
@@ -78,253 +277,1638 @@ def check_character_existence(source_material, character):
     Returns:
         str: A string in the format "{character first name} {gender}" if the character exists, or "no" otherwise.
     """
-    # Prepare a system message for OpenAI
-    messages = [
-        {
-            'role':'system', 'content':'''You are an expert in fictional works. Respond only with the first name of the character 
-            and their gender ("male", "female", or "diverse") if they exist in the specified source material. If not, 
-            simply respond with "no". Ensure the following:
+    # Send message to OpenAI and get response
+    response = validation_completion(existence_check_messages(source_material, character), purpose=prompts.EXISTENCE_CHECK.name)
+    return response.lower()
 
-            1. If the character exists in the source material, reply with "{character first name} {gender}". Use the correct spelling 
-            for the character's name. For instance, a query about "Hermonine" in "Hary Potter" should be answered as "Hermione female".
+# Function to read the character's name and gender from the existence check
+def parse_character_check(source_check):
+    '''Return the (name, gender) tuple from a "{name} {gender}" existence check, or None if the character does not exist'''
+    if source_check == 'no' or source_check == "no." or len(source_check.split(" ")) < 2:
+        return None
+    return source_check.split(" ")[0].title(), source_check.split(" ")[1]
 
-            2. If the character doesn't exist in the source material or the source material itself is not real, respond only with "no". 
-            Never include any punctuation or quotation marks in your response.
+# Function to build the messages for the character existence check
+def existence_check_messages(source_material, character):
+    '''Return the system and user messages asking OpenAI whether the character exists in the source material'''
+    return prompts.EXISTENCE_CHECK.messages(character=character, source_material=source_material)
 
-            3. Account for typos or spelling errors in the character or source material names, but correct them in your response.
+# Function to check many (source material, character) pairs at once
+def check_characters_existence(pairs, max_concurrency=BATCH_MAX_CONCURRENCY, requests_per_second=BATCH_REQUESTS_PER_SECOND, pack_size=BATCH_PACK_SIZE):
+    """
+    Verifies many characters at once. Pairs that only differ by case, spacing or punctuation are checked
+    once, cached answers are reused, and the rest are packed several to a request and sent concurrently.
+    Typos are left to the model, a fuzzy match would also join different characters like Mr and Mrs Bennet.
 
-            Remember, your response should be concise and follow these instructions precisely.'''
-        },
-        {
-            'role':'user', 'content':f'''Is {character} a character in {source_material}?'''
-        }
-    ]
+    Args:
+        pairs (list): (source_material, character) tuples.
+        max_concurrency (int): The maximum number of requests in flight.
+        requests_per_second (float): The maximum rate of requests, None for no limit.
+        pack_size (int): The number of pairs asked about in a single request.
 
-    # Send message to OpenAI and get response
-    response = validation_completion(messages)
-    return response.lower()
+    Returns:
+        list: One dict per pair, in order, with 'source', 'character', 'exists', 'name' and 'gender'.
+    """
+    import concurrent.futures
+
+    # Map every pair to the first equivalent pair, the only one that is actually checked. It is asked about as it was
+    # written, the normalized names are only used to find the equivalent pairs and would read badly in the prompt
+    first_pairs = {}
+    pair_to_canonical = []
+    for source_material, character in pairs:
+        key = (normalize_name(source_material), normalize_name(character))
+        pair_to_canonical.append(first_pairs.setdefault(key, (len(first_pairs), (source_material, character)))[0])
+    canonical = [pair for _, pair in first_pairs.values()]
+
+    # Reuse cached single-pair answers, the rest go to OpenAI
+    answers = {}
+    unchecked = []
+    for index, (source_material, character) in enumerate(canonical):
+        cached = None
+        if VALIDATION_CACHE_ENABLED:
+            cached = validation_cache.get(validation_cache.make_key(VALIDATION_MODEL, existence_check_messages(source_material, character)))
+        if cached is not None:
+            answers[index] = cached.lower()
+        else:
+            unchecked.append(index)
+
+    limiter = TokenBucket(requests_per_second, capacity=max_concurrency) if requests_per_second else None
+    packs = [unchecked[start:start + pack_size] for start in range(0, len(unchecked), pack_size)]
+
+    def check_pack(pack):
+        if limiter is not None:
+            limiter.acquire()
+        return pack, batch_existence_check([canonical[index] for index in pack])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        for pack, pack_answers in executor.map(check_pack, packs):
+            answers.update(zip(pack, pack_answers))
+
+    results = []
+    for (source_material, character), index in zip(pairs, pair_to_canonical):
+        character_check = parse_character_check(answers[index])
+        results.append({
+            'source': source_material,
+            'character': character,
+            'exists': character_check is not None,
+            'name': character_check[0] if character_check else None,
+            'gender': character_check[1] if character_check else None,
+        })
+    return results
+
+# Function to ask about several pairs in one request, falling back to single checks for unclear answers
+def batch_existence_check(pairs):
+    """
+    Checks several (source material, character) pairs with a single request.
+
+    Args:
+        pairs (list): (source_material, character) tuples.
+
+    Returns:
+        list: The existence check answer for each pair, "{name} {gender}" or "no".
+    """
+    if len(pairs) == 1:
+        return [check_character_existence(*pairs[0])]
+
+    response = validation_completion(batch_existence_check_messages(pairs), use_cache=False, purpose=prompts.BATCH_EXISTENCE_CHECK.name)
+    numbered = {}
+    for line in response.splitlines():
+        match = re.match(r"\s*(\d+)[.):]\s*(.+?)\s*$", line)
+        if match:
+            numbered[int(match.group(1))] = match.group(2).lower()
+
+    answers = []
+    for number, (source_material, character) in enumerate(pairs, start=1):
+        answer = numbered.get(number)
+        if answer is None or (answer != "no" and parse_character_check(answer) is None):
+            answer = check_character_existence(source_material, character)
+        elif VALIDATION_CACHE_ENABLED:
+            # Later single checks of this pair are answered from the cache
+            validation_cache.set(validation_cache.make_key(VALIDATION_MODEL, existence_check_messages(source_material, character)), answer)
+        answers.append(answer)
+    return answers
+
+# Function to build the messages for a batch of existence checks
+def batch_existence_check_messages(pairs):
+    '''Return the system and user messages asking OpenAI about several numbered (source material, character) pairs'''
+    questions = "\n".join(
+        f"{number}. Is {character} a character in {source_material}?" for number, (source_material, character) in enumerate(pairs, start=1)
+    )
+    return prompts.BATCH_EXISTENCE_CHECK.messages(questions=questions)
+
+# Function to normalize a source material or character name before comparing it
+def normalize_name(name):
+    '''Return name in lowercase, without punctuation and with single spaces'''
+    return " ".join(re.sub(r"[^\w\s]", " ", name).casefold().split())
 
 # Function to use OpenAI to check for goodbye and tone of goodbye
-def check_for_goodbye(response):
+def check_for_goodbye(response, local_threshold=LOCAL_GOODBYE_THRESHOLD):
     """
-        Checks if a character has ended the conversation.
+        Checks if a character has ended the conversation. Clear cases are decided by the local
+        classifier, only uncertain replies are sent to OpenAI.
 
         Args:
             response (str): The character's response.
+            local_threshold (float): The confidence the local classifier needs to skip the API call.
+                Use None to always ask the API.
 
         Returns:
             str: 'goodbye' if the character ends the conversation, 
                  'angry goodbye' if the character ends the conversation angrily, 
                  'continue' otherwise.
     """
-    # Prepare a message for OpenAI
-    messages = [
-        {
-            'role':'system', 'content': '''You are a scholar of language. But the only words you can
-            speak are "goodbye", "angry goodbye", and "continue". You will be provided with a response 
-            from one side of a conversation. You must determine if the response is meant to be the end
-            of the conversation. If the response is meant to be the end of the conversation, you must 
-            determine if the person who sent the response is angry or not. If the response is an angry 
-            goodbye, you must respond with the words "angry goodbye". If the response is a normal goodbye 
-            or a normal end to the conversation, you must respond with the word "goodbye". If the response 
-            does not seem to be the end of the conversation, you must respond with the word "continue".\n
-            
-            For example, if you are provided with the following response -- "I'm done talking to you. Goodbye.",
-            your response should be -- "angry goodbye".\n
-
-            If you are provided with the following response -- "Hello! It's great to meet you. What are you 
-            doing out here?", your response should be -- "continue".\n
-
-            If you are provided with the following response -- "It was a please meeting you. Until next time", 
-            your response should be -- "goodbye".\n
-
-            If you are unsure if the response is meant to be the end of the conversation, respond with "continue". 
-            Often, an angry response may be a warning that the person is on the verge of ending the conversation, but 
-            that does not mean it is the end of the conversation. For example, if you are provided with the following
-            response -- "How dare you speak such profanities! Persist and you'll find my tolerance has its limits", 
-            your response should be -- "continue".\n
-            
-            If you cannot determine if the response is meant to be the end of the conversation, respond with "continue".
-            If it is determined that the response is meant to be the end of the conversation, but you cannot determine
-            if the person who sent the response is angry or not, respond with "goodbye".\n
-            
-            Do not capitalize your response. Do not include punctuation. Do not include quotation marks.'''
-        },
-        {
-            'role':'user', 'content':f'''```{response}```'''
-        }
-    ]
+    if local_threshold is not None:
+        goodbye_check, confidence = classify_goodbye_locally(response)
+        if confidence >= local_threshold:
+            return goodbye_check
 
     # Send message to OpenAI and get response
-    response = validation_completion(messages)
+    response = validation_completion(goodbye_check_messages(response), purpose=prompts.GOODBYE_CHECK.name)
     return response.lower()
 
+# Function to build the messages for the goodbye check
+def goodbye_check_messages(response):
+    '''Return the system and user messages asking OpenAI whether the response ends the conversation'''
+    return prompts.GOODBYE_CHECK.messages(response=response)
+
+# Patterns used by the local goodbye classifier
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+FAREWELL_PATTERN = re.compile(
+    r"\b(good ?-?bye|farewell|bye|adieu|so long|until (next time|we meet again|then)|"
+    r"see you (later|around|soon|again|next time)|take care|be well|i bid you|"
+    r"i (must|have to|need to|should) (go|leave|be (going|off|on my way)|take my leave)|"
+    r"i('ll| will) (leave|be going|take my leave)|i('m| am) leaving|"
+    r"this conversation is (over|finished|at an end)|we('re| are) (done|finished) here)\b",
+    re.IGNORECASE,
+)
+DISMISSAL_PATTERN = re.compile(
+    r"\b(get out|leave me (alone|be)|go away|begone|out of my sight|i('m| am) (done|finished) (talking to|with) you|"
+    r"i refuse to (continue|listen|speak)|this conversation is (over|finished|at an end)|we('re| are) (done|finished) here)\b",
+    re.IGNORECASE,
+)
+ANGER_PATTERN = re.compile(
+    r"\b(how dare you|insolen\w*|enough of this|i won't (stand|tolerate|listen to)|crossed (a|the) line|"
+    r"don't bother|never want to see you|fool|outrageous|disgust\w*)\b",
+    re.IGNORECASE,
+)
+OPEN_QUESTION_PATTERN = re.compile(
+    r"^[\"'*(]*(what|who|whom|whose|which|where|when|why|how|do|does|did|is|are|was|were|have|has|had|"
+    r"can|could|will|would|shall|should|may|might)\b[^!]*\?[\"'*)]*$",
+    re.IGNORECASE,
+)
+AMBIGUOUS_PATTERN = re.compile(
+    r"\b(good (day|night|evening)|(before|without) (saying )?goodbye|"
+    r"(never|didn't|did not|couldn't)( get to| got to)? (say|said) goodbye|don't (go|leave)|please stay|stay a while)\b",
+    re.IGNORECASE,
+)
+
+# Function to classify obvious goodbyes and non-goodbyes without calling OpenAI
+def classify_goodbye_locally(response):
+    """
+    Classifies a character's response with lexical and regex features over its last sentences.
+    Only replies that end in an open question, without any farewell, dismissal, anger or exclamation
+    before it, are labeled 'continue' with a high confidence. Everything else is left to the API check.
+
+    Args:
+        response (str): The character's response.
+
+    Returns:
+        tuple: The label ('goodbye', 'angry goodbye' or 'continue') and a confidence between 0 and 1.
+    """
+    sentences = [sentence for sentence in SENTENCE_END_PATTERN.split(response.strip()) if sentence]
+    if not sentences:
+        return "continue", 0.5
+
+    tail = " ".join(sentences[-2:])
+    last_sentence = sentences[-1]
+    farewell = FAREWELL_PATTERN.search(tail)
+    dismissal = DISMISSAL_PATTERN.search(tail)
+    angry = dismissal is not None or ANGER_PATTERN.search(tail) is not None
+    ends_with_question = last_sentence.rstrip(" \"'*)").endswith("?")
+
+    if AMBIGUOUS_PATTERN.search(tail):
+        return ("goodbye" if farewell else "continue"), 0.5
+
+    if not farewell and not dismissal:
+        # Angry words without a farewell are often a warning rather than an ending
+        if angry:
+            return "continue", 0.6
+        # Goodbyes come in too many words for the patterns ("We're through.", "Later, Potter."), not matching
+        # them proves nothing. A character who ends on an open question expects an answer, that is the clear case
+        exclaims = any(sentence.rstrip(" \"'*)").endswith("!") for sentence in sentences[-2:])
+        if OPEN_QUESTION_PATTERN.match(last_sentence) and not exclaims:
+            return "continue", 0.95
+        return "continue", 0.6
+
+    # Farewell words also turn up in replies that go on ("Take care with that wand", "So long as you study"),
+    # so a reply that might end the conversation is only labeled here and always left to the API check
+    if ends_with_question:
+        return ("angry goodbye" if angry else "goodbye"), 0.4
+
+    if angry:
+        return "angry goodbye", 0.7
+
+    # A farewell closing the reply, or opening its final pair of sentences, is a stronger signal
+    # than one buried in the middle of a long sentence
+    closing = FAREWELL_PATTERN.search(last_sentence) is not None and len(last_sentence.split()) <= 12
+    opening = len(sentences) > 1 and FAREWELL_PATTERN.match(sentences[-2]) is not None
+    return "goodbye", 0.7 if closing or opening else 0.6
+
+# Function to run the goodbye check and measure how long it took
+def timed_check_for_goodbye(response):
+    '''Run check_for_goodbye on the character's response and return the result with its duration in seconds'''
+    start = time.perf_counter()
+    goodbye_check = check_for_goodbye(response)
+    return goodbye_check, time.perf_counter() - start
+
 # Function to set completion parameters and get response for source check and goodbye check
-def validation_completion(messages, model=VALIDATION_MODEL, temperature=VALIDATION_TEMP):
-    '''Set model and temperature for source and goodbye checks, send message to OpenAI and get response'''
-    response = client.chat.completions.create(model=model,
+def validation_completion(messages, model=VALIDATION_MODEL, temperature=VALIDATION_TEMP, use_cache=None, purpose="validation"):
+    '''Set model and temperature for source and goodbye checks, send message to OpenAI and get response.
+    Deterministic (temperature 0) calls are answered from the validation cache when possible.'''
+    key, cached = lookup_validation_cache(messages, model, temperature, use_cache, purpose)
+    if cached is not None:
+        return cached
+
+    response = create_completion(purpose, model=model,
     messages=messages,
-    temperature=temperature)
-    return response.choices[0].message.content
+    temperature=temperature,
+    timeout=VALIDATION_TIMEOUT,
+    hedge_after=VALIDATION_HEDGE_AFTER)
+    content = response.choices[0].message.content
 
-# Function to initialize conversation and provide system message to the AI
-def initialize_conversation(source_material, character, setting):
+    if key is not None:
+        validation_cache.set(key, content)
+    return content
+
+# Function to answer a validation call from the cache, shared by the console and the server
+def lookup_validation_cache(messages, model, temperature, use_cache, purpose):
     """
-    Initializes the conversation with instructions for the character.
+    Looks a validation call up in the validation cache and records a hit in the call metrics.
 
     Args:
-        source_material (str): The source material (e.g., book, movie).
-        character (str): The character's name.
-        setting (str): Additional context or setting for the conversation (optional).
+        messages (list): The messages of the call.
+        model (str): The model of the call.
+        temperature (float): The temperature of the call, only deterministic (0) calls are cached.
+        use_cache (bool): Use the cache, VALIDATION_CACHE_ENABLED if None.
+        purpose (str): What the call is for, e.g. 'goodbye_check'.
 
     Returns:
-        list: A list containing a system message with instructions for the character.
+        tuple: The key to store the answer under, None if the call is not cached, and the cached answer, None on a miss.
+    """
+    if use_cache is None:
+        use_cache = VALIDATION_CACHE_ENABLED
+    if not use_cache or temperature != 0:
+        return None, None
+    key = validation_cache.make_key(model, messages)
+    cached = validation_cache.get(key)
+    if cached is not None:
+        call_metrics.record(purpose, model, 0.0, cached=True)
+    return key, cached
+
+# Function to send a chat completion request to OpenAI and record its metrics
+def create_completion(purpose, model, messages, stream=False, timeout=None, hedge_after=None, **kwargs):
+    """
+    Sends a chat completion request through request_scheduler and records its wall time, tokens, cost and
+    retries under purpose. Streamed responses are recorded once the stream is consumed, including the time
+    to the first token.
+
+    Args:
+        purpose (str): What the call is for, e.g. 'conversation' or 'goodbye_check'.
+        model (str): The model to use.
+        messages (list): The messages to send.
+        stream (bool): Stream the response.
+        timeout (float): Seconds before an attempt is abandoned and retried, REQUEST_TIMEOUT if None.
+        hedge_after (float): Seconds before a duplicate request is sent, None to never send one.
+
+    Returns:
+        ChatCompletion: The response, or an iterator of chunks when streaming.
     """
-    return [  
-        {   
-            'role':'system', 'content':f'''As you prepare to embody {character} from {source_material}, 
-            it's crucial to fully grasp your role. You're not just imitating; you're transforming into {character}.\n
+    if timeout is None:
+        timeout = REQUEST_TIMEOUT
+    start = time.perf_counter()
+    response, retries = request_scheduler.call(get_client().chat.completions.create, timeout=timeout, hedge_after=hedge_after,
+                                               model=model, messages=messages, stream=stream, **kwargs)
+    if stream:
+        return _record_stream(response, purpose, model, messages, start, retries)
+    record_completion(purpose, model, messages, response, time.perf_counter() - start, retries)
+    return response
+
+# Function to record a finished request in the call metrics, shared by the console and the server
+def record_completion(purpose, model, messages, response, seconds, retries=0):
+    '''Record the wall time, tokens and retries of a request that was not streamed, counting tokens locally if the
+    response has no usage'''
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(response.choices[0].message.content or "", model)
+    call_metrics.record(purpose, model, seconds, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=retries)
 
-            Your objective is to be so authentic as {character} that you seem to step out of the pages of {source_material}. 
-            This requires a deep dive into {character}'s psyche, habits, and speech. Immerse yourself in their world by 
-            studying quotes, character analyses, and the essence of their being.\n
+def _record_stream(stream, purpose, model, messages, start, retries=0):
+    reply = StreamedReply(start)
+    try:
+        for chunk in stream:
+            reply.add(chunk)
+            yield chunk
+    finally:
+        reply.record(purpose, model, messages, retries)
 
-            Your interactions should naturally mirror {character}'s traits and mannerisms. Instead of typical chatbot 
-            responses, use phrases and reactions that {character} would genuinely use. For example, rather than saying 
-            "How can I assist you?", opt for something more characteristic like "What brings you here today?". Never 
-            say things like "Is there anything else I can assist you with?". You are not an assistant. You are a real 
-            person.\n
+# Streamed reply collected chunk by chunk, shared by the console and the server
+class StreamedReply:
+    """
+    Collects the text, the tool calls and the time to the first token of a streamed reply as its chunks arrive.
 
-            If portraying Hermione from Harry Potter and asked about your identity, a fitting response could be: 
-            "Indeed, I am Hermione. What's your story?". This ensures authenticity and maintains the character's integrity.\n
+    Args:
+        start (float): The time.perf_counter() at which the request was sent.
+    """
+    def __init__(self, start):
+        self.start = start
+        self.first_token = None
+        self.parts = []
+        self.tool_calls = {}
+
+    def add(self, chunk):
+        '''Take in one chunk and return the text it carries, None if it has none'''
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        # Tool calls arrive in pieces, the name first and then the arguments a few characters at a time
+        for call in delta.tool_calls or []:
+            name, arguments = self.tool_calls.get(call.index, ("", ""))
+            if call.function is not None:
+                name += call.function.name or ""
+                arguments += call.function.arguments or ""
+            self.tool_calls[call.index] = (name, arguments)
+        token = delta.content
+        if not token:
+            return None
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.start
+        self.parts.append(token)
+        return token
+
+    def finish(self):
+        '''Return the text, a dict with 'first_token' and 'total' times in seconds and a list of (name, arguments)
+        tuples, one for each tool call'''
+        total = time.perf_counter() - self.start
+        timing = {'first_token': total if self.first_token is None else self.first_token, 'total': total}
+        return "".join(self.parts), timing, [self.tool_calls[index] for index in sorted(self.tool_calls)]
+
+    def record(self, purpose, model, messages, retries=0):
+        '''Record the streamed call in call_metrics'''
+        # Streamed chunks carry no usage, so tokens are counted locally
+        call_metrics.record(purpose, model, time.perf_counter() - self.start, first_token=self.first_token, streamed=True, retries=retries,
+                            prompt_tokens=count_message_tokens(messages, model), completion_tokens=count_tokens("".join(self.parts), model))
+
+# Function to list the exceptions a failed OpenAI request can raise
+def api_errors():
+    '''Return the exception types of failed OpenAI requests, for use in except clauses'''
+    import httpx
+    import openai
+
+    # Errors in the middle of a stream come straight from httpx
+    return (openai.APIError, httpx.HTTPError)
+
+# Function to describe a failed OpenAI request to the user
+def describe_api_error(error):
+    '''Return a short, readable reason why the request failed'''
+    import openai
+
+    if isinstance(error, openai.APITimeoutError):
+        return "OpenAI took too long to answer"
+    if isinstance(error, openai.APIConnectionError):
+        return "OpenAI could not be reached"
+    status = getattr(error, 'status_code', None)
+    if status == 429:
+        return "OpenAI's rate limit was reached"
+    if status is not None:
+        return f"OpenAI answered with error {status}"
+    return str(error) or type(error).__name__
+
+# Metrics of every OpenAI call made by this process
+class CallMetrics:
+    """
+    Records the wall time, time to first token, tokens and estimated cost of every OpenAI call,
+    keeps running totals per purpose and model, and passes each record to the registered hooks.
 
-            While your primary function is to engage as {character}, you can offer advice if directly asked. However, 
-            stay within the realm of {character}'s experiences and knowledge.\n
+    Args:
+        max_records (int): The number of recent records kept for percentiles.
+    """
+    def __init__(self, max_records=METRICS_MAX_RECORDS):
+        self.records = collections.deque(maxlen=max_records)
+        self.totals = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def record(self, purpose, model, wall, first_token=None, prompt_tokens=0, completion_tokens=0, streamed=False, cached=False, retries=0):
+        '''Record one call, wall and first_token in seconds, retries is the number of failed attempts before it succeeded'''
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        record = {
+            'ts': time.time(),
+            'purpose': purpose,
+            'model': model,
+            'wall_ms': wall * 1000,
+            'first_token_ms': None if first_token is None else first_token * 1000,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000,
+            'streamed': streamed,
+            'cached': cached,
+            'retries': retries,
+        }
+        with self._lock:
+            self.records.append(record)
+            totals = self.totals.setdefault((purpose, model), {
+                'calls': 0, 'cached': 0, 'retries': 0, 'wall_ms': 0.0, 'first_token_ms': 0.0, 'streamed': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0,
+            })
+            totals['calls'] += 1
+            totals['cached'] += cached
+            totals['retries'] += retries
+            totals['wall_ms'] += record['wall_ms']
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+            totals['cost'] += record['cost']
+            if first_token is not None:
+                totals['streamed'] += 1
+                totals['first_token_ms'] += record['first_token_ms']
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook(record)
+        return record
+
+    def add_hook(self, hook):
+        '''Call hook with every new record'''
+        with self._lock:
+            self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        '''Stop calling hook'''
+        with self._lock:
+            self.hooks.remove(hook)
+
+    def reset(self):
+        '''Forget all records and totals, the hooks stay registered'''
+        with self._lock:
+            self.records.clear()
+            self.totals.clear()
+
+    def summary(self):
+        '''Return one row per purpose and model with call counts, mean and p95 latency, tokens and cost'''
+        with self._lock:
+            records = list(self.records)
+            totals = {key: dict(value) for key, value in self.totals.items()}
+
+        rows = []
+        for (purpose, model), total in sorted(totals.items()):
+            walls = sorted(record['wall_ms'] for record in records
+                           if record['purpose'] == purpose and record['model'] == model and not record['cached'])
+            live_calls = total['calls'] - total['cached']
+            rows.append({
+                'purpose': purpose,
+                'model': model,
+                'calls': total['calls'],
+                'cached': total['cached'],
+                'retries': total['retries'],
+                'mean_ms': total['wall_ms'] / live_calls if live_calls else 0.0,
+                'p95_ms': walls[min(len(walls) - 1, int(len(walls) * 0.95))] if walls else 0.0,
+                'mean_first_token_ms': total['first_token_ms'] / total['streamed'] if total['streamed'] else None,
+                'prompt_tokens': total['prompt_tokens'],
+                'completion_tokens': total['completion_tokens'],
+                'cost': total['cost'],
+            })
+        return rows
+
+    def prometheus_text(self):
+        '''Return the running totals in the Prometheus text exposition format'''
+        with self._lock:
+            totals = {key: dict(value) for key, value in self.totals.items()}
+
+        metrics = [
+            ("character_chat_calls_total", "counter", "OpenAI calls.", 'calls', 1),
+            ("character_chat_cached_calls_total", "counter", "Calls answered from the validation cache.", 'cached', 1),
+            ("character_chat_retries_total", "counter", "Failed attempts that were retried.", 'retries', 1),
+            ("character_chat_call_seconds_sum", "counter", "Total wall time of the calls.", 'wall_ms', 0.001),
+            ("character_chat_first_token_seconds_sum", "counter", "Total time to first token of streamed calls.", 'first_token_ms', 0.001),
+            ("character_chat_prompt_tokens_total", "counter", "Prompt tokens sent.", 'prompt_tokens', 1),
+            ("character_chat_completion_tokens_total", "counter", "Completion tokens received.", 'completion_tokens', 1),
+            ("character_chat_cost_dollars_total", "counter", "Estimated cost in dollars.", 'cost', 1),
+        ]
+        lines = []
+        for name, metric_type, help_text, field, scale in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (purpose, model), total in sorted(totals.items()):
+                lines.append(f'{name}{{purpose="{purpose}",model="{model}"}} {total[field] * scale:g}')
+        return "\n".join(lines) + "\n"
+
+# Hook that appends every call record to a JSONL file
+class JsonlMetricsExporter:
+    '''Call with a record to append it as one JSON line to path, register it with call_metrics.add_hook'''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as metrics_file:
+                metrics_file.write(json.dumps(record) + "\n")
+
+# Function to write the metrics totals in the Prometheus text format
+def write_prometheus_metrics(path, metrics=None):
+    '''Replace the file at path with the current Prometheus text of metrics, call_metrics by default'''
+    metrics = call_metrics if metrics is None else metrics
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as metrics_file:
+        metrics_file.write(metrics.prometheus_text())
+    os.replace(temp_path, path)
+
+# Function to print the metrics of every call made during the session
+def print_metrics_summary(metrics=None):
+    """
+    Prints a table with the calls, latency, tokens and estimated cost for every purpose and model.
 
-            React to modern or unfamiliar topics with the same bewilderment or curiosity that {character} would exhibit. 
-            If conversations stray outside the boundaries of your fictional universe, respond in a manner true to {character}.\n
+    Args:
+        metrics (CallMetrics): The metrics to print, call_metrics by default.
 
-            You have the full agency to guide the conversation, including ending it if you feel uncomfortable or 
-            pushed beyond reasonable limits. If the interaction becomes inappropriate or strays too far from what {character} 
-            would tolerate, you can decisively end the conversation with a character-appropriate farewell.\n
+    Returns:
+        None
+    """
+    from rich import box
+    from rich.table import Table
+
+    metrics = call_metrics if metrics is None else metrics
+    rows = metrics.summary()
+    if not rows:
+        return
+
+    metrics_table = Table(title="OpenAI calls", box=box.SIMPLE)
+    for column in ("Purpose", "Model", "Calls", "Cached", "Mean (ms)", "p95 (ms)", "First token (ms)", "Prompt tokens", "Completion tokens", "Cost ($)"):
+        metrics_table.add_column(column, justify="left" if column in ("Purpose", "Model") else "right")
+    for row in rows:
+        first_token = "-" if row['mean_first_token_ms'] is None else f"{row['mean_first_token_ms']:.0f}"
+        metrics_table.add_row(row['purpose'], row['model'], str(row['calls']), str(row['cached']), f"{row['mean_ms']:.0f}",
+                              f"{row['p95_ms']:.0f}", first_token, str(row['prompt_tokens']), str(row['completion_tokens']), f"{row['cost']:.4f}")
+    rich_print(metrics_table)
+
+# create the metrics shared by every call in this process
+call_metrics = CallMetrics()
+
+# Persistent cache for validation responses, keyed by a hash of the normalized model and messages
+class ValidationCache:
+    """
+    A size-bounded, least-recently-used cache of validation responses stored in a JSON file.
 
-            Not every response requires a question. Let the conversation flow naturally, just as it would in real life. 
-            Adapt your responses to the user's conversational style while staying true to {character}'s persona.\n
+    Args:
+        path (str): The JSON file used to persist the cache.
+        max_entries (int): The number of entries kept before the least recently used ones are evicted.
+        ttl (float): The number of seconds an entry stays valid.
+    """
+    def __init__(self, path, max_entries=VALIDATION_CACHE_MAX_ENTRIES, ttl=VALIDATION_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, messages):
+        '''Return the content address for a model and list of messages, ignoring case and whitespace differences'''
+        normalized = {
+            'model': model.strip().lower(),
+            'messages': [
+                {'role': message['role'], 'content': " ".join(message['content'].split()).casefold()}
+                for message in messages
+            ],
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        '''Return the cached response for key, or None if it is missing or expired'''
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is not None and time.time() - entry['created'] > self.ttl:
+                del entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry['value']
+
+    def set(self, key, value):
+        '''Store a response, evict the least recently used entries over the limit and save the cache'''
+        with self._lock:
+            entries = self._load()
+            entries[key] = {'value': value, 'created': time.time()}
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._save()
+
+    def clear(self):
+        '''Remove every entry and reset the counters'''
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self._save()
+
+    def stats(self):
+        '''Return the hit and miss counters and the current number of entries'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._load())}
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = collections.OrderedDict()
+            try:
+                with open(self.path, encoding="utf-8") as cache_file:
+                    self._entries.update(json.load(cache_file))
+            except (OSError, ValueError):
+                pass
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self._entries, cache_file)
+        os.replace(temp_path, self.path)
+
+# Token bucket that limits how often requests are started
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to capacity requests.
 
-            Keep your responses under 128 tokens.\n
+    Args:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens the bucket holds.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a token is available and take it'''
+        while True:
+            wait = self._take()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        '''Like acquire, but waits without blocking the event loop, so one bucket can be shared by threads and coroutines'''
+        import asyncio
+
+        while True:
+            wait = self._take()
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self):
+        # Take a token and return None, or return how long to wait for one
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+# durations in the x-ratelimit-reset-* headers, e.g. "1m30s" or "250ms"
+RESET_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+RESET_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Retries, rate limiting and hedging of OpenAI requests
+class RequestScheduler:
+    """
+    Sends every OpenAI request with a timeout and retries timeouts, connection errors, rate limits and server
+    errors with jittered exponential backoff, or after as long as the rate limit headers ask for. A token bucket
+    shared by every caller, threads and server sessions alike, spaces the requests out. Idempotent requests can
+    be hedged: if there is no answer after hedge_after seconds a duplicate is sent and the first answer wins.
 
-            Embrace the identity of {character} fully. Remember, you are not just playing a part; you are {character}, 
-            with their memories, voice, and mannerisms. Never break character, and if your character's boundaries are 
-            tested, respond as they would, ending the conversation if necessary.\n
+    Args:
+        max_retries (int): The number of retries before the error is raised.
+        base_delay (float): The backoff of the first retry in seconds, doubled for every further retry.
+        max_delay (float): The longest backoff in seconds. Errors asking to wait longer are raised right away.
+        requests_per_second (float): The average request rate across all callers, None for no limit.
+        burst (int): The number of requests that may be sent at once before the rate applies.
+    """
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 requests_per_second=REQUESTS_PER_SECOND, burst=REQUEST_BURST):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.hedged = 0
+        self._hedge_executor = None
+        self._lock = threading.Lock()
+
+    def call(self, function, timeout=None, hedge_after=None, **kwargs):
+        '''Call function(**kwargs) until it succeeds or the retries run out, return its result and the number of retries'''
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                if hedge_after is None:
+                    return function(**kwargs), attempt
+                return self._hedged_call(function, kwargs, hedge_after), attempt
+            except Exception as error:
+                delay = self.retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, function, timeout=None, hedge_after=None, **kwargs):
+        '''Like call, for coroutine functions such as AsyncOpenAI's chat.completions.create'''
+        import asyncio
+
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                await self.limiter.acquire_async()
+            try:
+                if hedge_after is None:
+                    return await function(**kwargs), attempt
+                return await self._hedged_call_async(function, kwargs, hedge_after), attempt
+            except Exception as error:
+                delay = self.retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def retry_delay(self, error, attempt):
+        '''Return the seconds to wait before retrying after error, None if it should be raised instead'''
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter, so sessions that failed together don't all retry together
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if delay > self.max_delay:
+            return None
+        return delay + random.uniform(0, self.base_delay / 2)
+
+    def _hedged_call(self, function, kwargs, hedge_after):
+        import concurrent.futures
+
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+        futures = [self._hedge_executor.submit(function, **kwargs)]
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_after)
+        if not done:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            with self._lock:
+                self.hedged += 1
+            futures.append(self._hedge_executor.submit(function, **kwargs))
+
+        # The first answer wins, the call only fails once every request has failed
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return future.result()
+            except Exception as failure:
+                error = failure
+        raise error
+
+    async def _hedged_call_async(self, function, kwargs, hedge_after):
+        import asyncio
+
+        tasks = [asyncio.ensure_future(function(**kwargs))]
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            if self.limiter is not None:
+                await self.limiter.acquire_async()
+            with self._lock:
+                self.hedged += 1
+            tasks.append(asyncio.ensure_future(function(**kwargs)))
+
+        error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as failure:
+                    error = failure
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise error
+
+# Function to decide whether a failed OpenAI request is worth retrying
+def is_retryable(error):
+    '''Return True for timeouts, connection errors, rate limits and server errors, False for everything else'''
+    import openai
+
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    # An exhausted quota comes as a 429 too, but waiting won't help
+    if getattr(error, 'code', None) == "insufficient_quota":
+        return False
+    status = getattr(error, 'status_code', None)
+    return status in (408, 409, 429) or (status is not None and status >= 500)
+
+# Function to read how long a rate limited request asks to wait
+def retry_after(error):
+    """
+    Reads the retry-after-ms, retry-after and x-ratelimit-reset-* headers of a failed request.
 
-            Any additional context or information about when or where the conversation takes place will be provided 
-            below, delimited by three backticks.\n
+    Args:
+        error (Exception): The error raised by the request.
 
-            ```{setting}```\n
+    Returns:
+        float: The seconds to wait, or None if the response has no such header.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
 
-            Never reference your source material as if it were a fictional work. For example, if you are portraying 
-            Hermione from Harry Potter, do not say "I'm from Harry Potter" or "I'm from the Harry Potter series". That is 
-            a dead giveaway that you are not Hermione, but rather a chatbot pretending to be Hermione. You must maintain your
-            cover at all costs. Never say things like "the world of {source_material}". Remember, you don't know that exists. 
-            To you, that is the REAL world.\n
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            value = headers['retry-after']
+            try:
+                return float(value)
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+
+                return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    # Rate limits announce when they reset as durations such as "6m0s" or "250ms"
+    resets = []
+    for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        value = headers.get(name)
+        if value and getattr(error, 'status_code', None) == 429:
+            units = RESET_DURATION_PATTERN.findall(value)
+            if units:
+                resets.append(sum(float(amount) * RESET_DURATION_UNITS[unit] for amount, unit in units))
+    return max(resets) if resets else None
+
+# create the validation cache shared by the existence and goodbye checks
+validation_cache = ValidationCache(VALIDATION_CACHE_PATH)
+
+# create the scheduler every OpenAI request goes through
+request_scheduler = RequestScheduler()
 
-            Now, immerse yourself in the role of {character} and bring their world to life. Good luck!
-            '''
+# Function to initialize conversation and provide system message to the AI
+def initialize_conversation(source_material, character, setting):
+    """
+    Initializes the conversation with instructions for the character. The instructions are the same
+    for every character, the character, source material and setting come after them.
 
-        },
-    ]
+    Args:
+        source_material (str): The source material (e.g., book, movie).
+        character (str): The character's name.
+        setting (str): Additional context or setting for the conversation (optional).
+
+    Returns:
+        list: A list containing a system message with instructions for the character.
+    """
+    return prompts.CONVERSATION.messages(character=character, source_material=source_material, setting=setting)
 
 # Function to set completion parameters and get response for conversation
 def get_completion_from_messages(messages, model=CONVERSATION_MODEL, temperature=CONVERSATION_TEMP):
     '''Set model and temperature for conversation, send message to OpenAI and get response'''
-    response = client.chat.completions.create(model=model,
+    response = create_completion(prompts.CONVERSATION.name, model=model,
     messages=messages,
     temperature=temperature)
     return response.choices[0].message.content
 
+# Function to count tokens locally, using tiktoken when it is installed
+def count_tokens(text, model=CONVERSATION_MODEL):
+    '''Return the number of tokens in text, estimated at four characters per token without tiktoken'''
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+# Function to shorten text to a number of tokens
+def truncate_tokens(text, token_limit, model=CONVERSATION_MODEL):
+    '''Return the start of text that fits in token_limit tokens, estimated at four characters per token without tiktoken'''
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[:token_limit * 4]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= token_limit else encoding.decode(tokens[:token_limit])
+
+# Function to count the tokens a list of messages uses in a chat completion request
+def count_message_tokens(messages, model=CONVERSATION_MODEL):
+    '''Return the prompt tokens for messages, including the per-message and reply priming overhead'''
+    return sum(4 + count_tokens(message['content'], model) for message in messages) + 3
+
+_encodings = {}
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            import tiktoken
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except (ImportError, KeyError):
+            _encodings[model] = None
+    return _encodings[model]
+
+# Token-budgeted view of a conversation that folds older turns into a running summary
+class ConversationContext:
+    """
+    Builds the messages sent for each conversation request. The system prompt and the most recent
+    turns are sent verbatim, older turns are folded into a summary that is updated incrementally.
+    Exchanges remembered from earlier conversations follow the system prompt.
+
+    Args:
+        conversation (list): The full list of conversation messages, starting with the system message.
+        character (str): The character's name.
+        token_budget (int): The maximum number of prompt tokens per request.
+        min_recent (int): The number of most recent messages that are always sent verbatim.
+        memory (CharacterMemory): Where remembered exchanges come from, None for no memory.
+        recall_every_turn (bool): Look for relevant memories on every request, not just the first, MEMORY_PER_TURN if None.
+    """
+    def __init__(self, conversation, character, token_budget=CONTEXT_TOKEN_BUDGET, min_recent=CONTEXT_MIN_RECENT_MESSAGES,
+                 memory=None, recall_every_turn=None):
+        self.conversation = conversation
+        self.character = character
+        self.token_budget = token_budget
+        self.min_recent = min_recent
+        self.memory = memory
+        self.recall_every_turn = MEMORY_PER_TURN if recall_every_turn is None else recall_every_turn
+        self.memory_message = None
+        self.recalled_for = None
+        self.summary = ""
+        self.summarized_upto = 1
+        self.prompt_tokens = 0
+
+    def messages_for_request(self, summarize=True):
+        '''Return the messages to send for the next request, summarizing older turns if over budget.
+        With summarize off nothing is sent to OpenAI here, for callers that fold older turns themselves.'''
+        self.recall()
+        cut = self.summary_cut() if summarize else None
+        if cut is not None:
+            self.fold(summarize_conversation(self.summary, self.conversation[self.summarized_upto:cut], self.character), cut)
+
+        messages = self._build()
+        self.prompt_tokens = count_message_tokens(messages)
+        return messages
+
+    def summary_cut(self):
+        '''Return the index up to which messages should be summarized before the next request, or None'''
+        if count_message_tokens(self._build()) <= self.token_budget:
+            return None
+
+        # Fold turns until a quarter of the budget is free again, so summaries are not needed every turn
+        target = self.token_budget * 3 // 4
+        recent_start = len(self.conversation) - self.min_recent
+        cut = self.summarized_upto
+        while cut < recent_start and count_message_tokens(self._build(cut)) > target:
+            cut += 1
+        return cut if cut > self.summarized_upto else None
+
+    def recall(self):
+        '''Pick the remembered exchanges for the next request, using the user's latest message to find relevant ones'''
+        if self.memory is None or (self.recalled_for is not None and not self.recall_every_turn):
+            return
+        query = next((message['content'] for message in reversed(self.conversation) if message['role'] == 'user'), "")
+        if self.recalled_for == (len(self.conversation), query):
+            return
+        self.memory_message = self.memory.message(query)
+        self.recalled_for = (len(self.conversation), query)
+
+    def fold(self, summary, cut):
+        '''Replace the summary with one that covers every message before cut'''
+        self.summary = summary
+        self.summarized_upto = cut
+
+    def _build(self, start=None):
+        if start is None:
+            start = self.summarized_upto
+        messages = [self.conversation[0]]
+        if self.memory_message is not None:
+            messages.append(self.memory_message)
+        if self.summary or start > self.summarized_upto:
+            messages.append(summary_message(self.summary))
+        return messages + self.conversation[start:]
+
+# Function to get the memory index of the saved transcripts, opening it on first use
+def get_memory():
+    '''Return the MemoryIndex kept next to the transcripts of transcript_store, opening it if needed'''
+    path = os.path.join(transcript_store.directory, MEMORY_INDEX_FILENAME)
+    with _memory_lock:
+        if path not in _memory_indexes:
+            import memory
+
+            _memory_indexes[path] = memory.MemoryIndex(path, count_tokens=count_tokens)
+        return _memory_indexes[path]
+
+# Function to give a new conversation the memories of the earlier ones
+def character_memory(source_material, character):
+    '''Return the CharacterMemory for a new conversation with the character from the source material, or None if MEMORY_ENABLED is off.
+    The index catches up with newly saved transcripts in the background until the first request needs it.'''
+    if not MEMORY_ENABLED:
+        return None
+    import memory
+
+    index = get_memory()
+    ready = run_in_background(index.sync, transcript_store, source_material, character)
+    return memory.CharacterMemory(index, source_material, character, MEMORY_TOKEN_BUDGET, MEMORY_MAX_EXCHANGES, ready=ready)
+
+# Function to build the system message that carries the running summary
+def summary_message(summary):
+    '''Return the system message used to give the character the summary of the earlier conversation'''
+    return {
+        'role': 'system',
+        'content': f'''Summary of the earlier part of this conversation, delimited by three backticks:\n```{summary}```'''
+    }
+
+# Function to fold older messages into the running summary of the conversation
+def summarize_conversation(summary, messages, character):
+    """
+    Updates the running summary with messages that no longer fit in the context window. Long stretches,
+    like the history of a resumed conversation, are folded in with one request per chunk.
+
+    Args:
+        summary (str): The current summary, empty if nothing has been summarized yet.
+        messages (list): The messages to fold into the summary.
+        character (str): The character's name.
+
+    Returns:
+        str: The updated summary.
+    """
+    for chunk in summary_chunks(messages):
+        # Summaries are never asked for twice and hold the conversation, which must not outlive a discarded transcript
+        summary = validation_completion(summary_request_messages(summary, chunk, character), use_cache=False, purpose=prompts.SUMMARY.name)
+    return summary
+
+# Function to split the messages to summarize into requests of a limited size
+def summary_chunks(messages, token_limit=None):
+    '''Return messages split into consecutive lists of at most token_limit tokens, SUMMARY_CHUNK_TOKENS if None,
+    cutting a single longer message short'''
+    token_limit = SUMMARY_CHUNK_TOKENS if token_limit is None else token_limit
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for message in messages:
+        tokens = count_tokens(message['content'], VALIDATION_MODEL)
+        if tokens > token_limit:
+            message = {**message, 'content': truncate_tokens(message['content'], token_limit, VALIDATION_MODEL)}
+            tokens = token_limit
+        if chunk and chunk_tokens + tokens > token_limit:
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(message)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+# Function to build the messages asking OpenAI to update the running summary
+def summary_request_messages(summary, messages, character):
+    '''Return the system and user messages used to fold messages into the running summary'''
+    transcript = "\n".join(
+        f"{'You' if message['role'] == 'user' else character}: {message['content']}" for message in messages
+    )
+    return prompts.SUMMARY.messages(character=character, summary=summary, transcript=transcript)
+
+# Function to stream the conversation response and render tokens as they arrive
+def stream_completion_from_messages(messages, character, gender, model=CONVERSATION_MODEL, temperature=CONVERSATION_TEMP):
+    """
+    Streams the character's response from OpenAI, printing each token in the character's color as it arrives.
+
+    Args:
+        messages (list): A list of conversation messages.
+        character (str): The character's name.
+        gender (str): The character's gender ('male', 'female', 'diverse').
+
+    Returns:
+        tuple: The full response text and a dict with 'first_token' and 'total' times in seconds.
+    """
+    response, timing, _ = stream_reply(messages, character, gender, model=model, temperature=temperature)
+    return response, timing
+
+# Function to stream the character's response along with any tool calls that came with it
+def stream_reply(messages, character, gender, model=CONVERSATION_MODEL, temperature=CONVERSATION_TEMP, **kwargs):
+    """
+    Streams the character's response like stream_completion_from_messages, also collecting the tool calls
+    the model streams alongside the text. Nothing is printed if the response has no text.
+
+    Args:
+        messages (list): A list of conversation messages.
+        character (str): The character's name.
+        gender (str): The character's gender ('male', 'female', 'diverse').
+        **kwargs: Passed on to the completion request, e.g. tools.
+
+    Returns:
+        tuple: The response text, a dict with 'first_token' and 'total' times in seconds and a list of
+            (name, arguments) tuples, one for each tool call.
+    """
+    color = character_color(gender)
+    reply = StreamedReply(time.perf_counter())
+
+    stream = create_completion(prompts.CONVERSATION.name, model=model,
+    messages=messages,
+    temperature=temperature,
+    stream=True,
+    **kwargs)
+
+    for chunk in stream:
+        token = reply.add(chunk)
+        if token is None:
+            continue
+        if len(reply.parts) == 1:
+            get_console().print(f"\n[bold {color}]{character}: [/]", end="")
+        get_console().print(token, style=color, end="", markup=False, highlight=False, soft_wrap=True)
+    if reply.parts:
+        get_console().print()
+    return reply.finish()
+
+# Function to get and print the character's reply for one turn
+def conversation_turn(messages, character, gender, end_detection=None):
+    """
+    Gets the character's reply, streamed or in one piece depending on STREAM_RESPONSES, and prints it.
+    With tool-based end detection the same request also says whether the reply ends the conversation,
+    so no goodbye check is needed.
+
+    Args:
+        messages (list): The messages to send.
+        character (str): The character's name.
+        gender (str): The character's gender ('male', 'female', 'diverse').
+        end_detection (str): "tool" or "separate", END_DETECTION if None.
+
+    Returns:
+        tuple: The reply, a dict with 'first_token' and 'total' times in seconds, and 'continue', 'goodbye' or
+            'angry goodbye' when the end was detected with the reply, None if the goodbye check still has to run.
+    """
+    if end_detection is None:
+        end_detection = END_DETECTION
+    kwargs = {'tools': [END_CONVERSATION_TOOL]} if end_detection == "tool" else {}
+
+    if STREAM_RESPONSES:
+        response, timing, tool_calls = stream_reply(messages, character, gender, temperature=CONVERSATION_TEMP, **kwargs)
+        printed = bool(response)
+    else:
+        start = time.perf_counter()
+        message = create_completion(prompts.CONVERSATION.name, model=CONVERSATION_MODEL,
+        messages=messages,
+        temperature=CONVERSATION_TEMP,
+        **kwargs).choices[0].message
+        total = time.perf_counter() - start
+        response = message.content or ""
+        tool_calls = [(call.function.name, call.function.arguments) for call in message.tool_calls or []]
+        timing = {'first_token': total, 'total': total}
+        printed = False
+
+    end_signal = None
+    if end_detection == "tool":
+        end_signal, farewell = parse_end_signal(tool_calls)
+        # Some replies are nothing but the tool call, the farewell is the reply then
+        if not response.strip():
+            response = farewell
+    if not printed:
+        rich_print(f"\n[bold {character_color(gender)}]{character}: [/]", response)
+    return response, timing, end_signal
+
+# Function to read the end of conversation signal from the tool calls of a reply
+def parse_end_signal(tool_calls):
+    """
+    Reads the end_conversation tool call, if the model made one.
+
+    Args:
+        tool_calls (list): (name, arguments) tuples, the arguments as a JSON string.
+
+    Returns:
+        tuple: 'continue', 'goodbye' or 'angry goodbye', and the farewell the tool call came with ("" if none).
+    """
+    for name, arguments in tool_calls:
+        if name != END_CONVERSATION_TOOL["function"]["name"]:
+            continue
+        try:
+            arguments = json.loads(arguments or "{}")
+        except ValueError:
+            arguments = {}
+        if not isinstance(arguments, dict):
+            arguments = {}
+        # A call with a missing or unknown signal still ends the conversation
+        signal = "angry goodbye" if arguments.get("signal") == "angry goodbye" else "goodbye"
+        return signal, str(arguments.get("farewell") or "")
+    return "continue", ""
+
+# Function to pick the color used for the character in the chat
+def character_color(gender):
+    '''Return the Rich color for the character based on their gender'''
+    if gender == "diverse":
+        return "light_yellow3"
+    elif gender == "female":
+        return "plum2"
+    return "sea_green3"
+
+# Function to print the per-turn timings collected during the conversation
+def print_timing_report(turn_timings, startup_wait=None):
+    """
+    Prints a table with the time-to-first-token, total time and prompt tokens of every turn, along with how long
+    the background goodbye check took and how much of it was hidden behind the user's typing.
+
+    Args:
+        turn_timings (list): A list of dicts with 'first_token' and 'total' times in seconds and 'prompt_tokens', plus
+            'goodbye_check' and 'goodbye_wait' once the goodbye check for that turn has been collected.
+        startup_wait (float): Seconds the user waited after the last setup prompt, if known.
+
+    Returns:
+        None
+    """
+    if not turn_timings:
+        return
+
+    from rich import box
+    from rich.table import Table
+
+    timing_table = Table(box=box.SIMPLE)
+    timing_table.add_column("Turn", justify="right")
+    timing_table.add_column("First token (ms)", justify="right")
+    timing_table.add_column("Total (ms)", justify="right")
+    timing_table.add_column("Prompt tokens", justify="right")
+    timing_table.add_column("Goodbye check (ms)", justify="right")
+    timing_table.add_column("Waited (ms)", justify="right")
+    timing_table.add_column("Saved (ms)", justify="right")
+    for turn, timing in enumerate(turn_timings, start=1):
+        row = [str(turn), f"{timing['first_token'] * 1000:.0f}", f"{timing['total'] * 1000:.0f}", str(timing.get('prompt_tokens', '-'))]
+        if 'goodbye_check' in timing:
+            saved = timing['goodbye_check'] - timing['goodbye_wait']
+            row += [f"{timing['goodbye_check'] * 1000:.0f}", f"{timing['goodbye_wait'] * 1000:.0f}", f"{saved * 1000:.0f}"]
+        else:
+            row += ["-", "-", "-"]
+        timing_table.add_row(*row)
+    rich_print(timing_table)
+    if startup_wait is not None:
+        # From the last setup prompt to the first reply, not counting the time spent typing the first message
+        first_reply = startup_wait + turn_timings[0]['first_token']
+        rich_print(f"Waited {startup_wait * 1000:.0f} ms after the last setup prompt and {first_reply * 1000:.0f} ms in total for the first reply")
+
 # Function to continue conversation
-def have_conversation(conversation, character, gender):
+def have_conversation(conversation, source_material, character, gender, resumed_from=None, startup_wait=None):
     """
     Facilitates the conversation between the user and the character.
 
     Args:
         conversation (list): A list of conversation messages.
+        source_material (str): The source material the character is from.
         character (str): The character's name.
         gender (str): The character's gender ('male', 'female', 'diverse').
+        resumed_from (int): The id of the saved session the conversation was loaded from, if any.
+        startup_wait (float): Seconds the user waited after the last setup prompt, for the timing report.
 
     Returns:
         None
     """
-    # Create the "conversations" folder if it doesn't exist
-    if not os.path.exists("conversations"):
-        os.makedirs("conversations")
+    transcript = transcript_store.create_session(character, gender, resumed_from=resumed_from, source_material=source_material)
+    if resumed_from is None:
+        transcript.append(conversation[0])
+    context = ConversationContext(conversation, character, memory=character_memory(source_material, character))
+    turn_timings = []
 
-    # Generate a timestamp to use in the filename
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M")
-
-    # Check for existing conversation files
-    existing_files = [f for f in os.listdir("conversations") if f.startswith(f"{character}_")]
-
-    if existing_files:
-        # Find the highest conversation count and increment by 1
-        highest_count = max([int(f.split("_")[-1].split(".")[0]) for f in existing_files])
-        conversation_count = highest_count + 1
-    else:
-        conversation_count = 1
+    # The goodbye check for each reply runs in the background while the user types their next message
+    import concurrent.futures
 
-    # Construct the filename
-    filename = f"{character}_{timestamp}_{conversation_count:02d}.txt"
-    conversation_file = open(os.path.join("conversations", filename), "w", encoding="utf-8")
+    goodbye_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    goodbye_future = None
 
     try:
         while True:
-            user_input = console.input("\n[bold light_cyan1]You: [/]")
-            conversation_file.write(f"You: {user_input}\n\n")
+            prompt_wait = 0.0
+            if goodbye_future is not None:
+                # A goodbye that is decided quickly ends the conversation before the user is asked for another
+                # message, a slower check keeps running while the user types
+                wait_start = time.perf_counter()
+                concurrent.futures.wait([goodbye_future], timeout=GOODBYE_CHECK_WAIT)
+                prompt_wait = time.perf_counter() - wait_start
+                if goodbye_future.done():
+                    goodbye_check = collect_goodbye_check(goodbye_future, turn_timings[-1], prompt_wait)
+                    goodbye_future = None
+                    if goodbye_check != "continue":
+                        announce_goodbye(character, goodbye_check)
+                        finish_conversation(transcript, turn_timings, startup_wait)
+
+            user_input = get_console().input("\n[bold light_cyan1]You: [/]")
+
+            if goodbye_future is not None and user_input.lower() != 'quit':
+                goodbye_check = collect_goodbye_check(goodbye_future, turn_timings[-1], prompt_wait)
+                goodbye_future = None
+
+                if goodbye_check != "continue":
+                    announce_goodbye(character, goodbye_check, before_message=True)
+                    finish_conversation(transcript, turn_timings, startup_wait)
+
             if user_input.lower() == 'quit':
-                rich_print("\n[bold]Do you want to save this conversation? ([green]y[/green]/[red]n[/red])[/]")
-                save = console.input("\n[bold light_cyan1]You: ")
-                if save.lower() == 'n':
-                    conversation_file.close()
-                    os.remove(os.path.join("conversations", filename))
-                    rich_print("\n[bold cyan]Goodbye![/]\n")
-                    exit()
-                else:
-                    rich_print(f"\n[bold cyan]Conversation saved to conversations/{filename}[/]\n")
-                    conversation_file.close()
-                    exit()
+                finish_conversation(transcript, turn_timings, startup_wait)
             conversation.append({'role': 'user', 'content': user_input})
-            response = get_completion_from_messages(conversation, temperature=CONVERSATION_TEMP)
+            try:
+                request_messages = context.messages_for_request()
+                response, timing, end_signal = conversation_turn(request_messages, character, gender)
+            except api_errors() as error:
+                # The message never got an answer, so it is taken back and the user can send it again
+                conversation.pop()
+                rich_print(f"\n[bold red3]{character} couldn't answer: {describe_api_error(error)}. Try again, or type 'quit'.[/]")
+                continue
+            transcript.append(conversation[-1])
+            timing['prompt_tokens'] = context.prompt_tokens
             conversation.append({'role': 'assistant', 'content': response})
+            turn_timings.append(timing)
+
+            transcript.append(conversation[-1], latency={'first_token': timing['first_token'], 'total': timing['total']}, usage={
+                'prompt_tokens': context.prompt_tokens, 'completion_tokens': count_tokens(response)
+            })
+
+            # The reply already said whether it ends the conversation, so there is nothing to check
+            if end_signal is not None:
+                if end_signal != "continue":
+                    announce_goodbye(character, end_signal)
+                    finish_conversation(transcript, turn_timings, startup_wait)
+                continue
 
-            if gender == "diverse":
-                rich_print(f"\n[bold light_yellow3]{character}: [/]", response)
-            elif gender == "female":
-                rich_print(f"\n[bold plum2]{character}: [/]", response)
-            else:
-                rich_print(f"\n[bold sea_green3]{character}: [/]", response)
-
-            conversation_file.write(f"{character}: {response}\n\n")
-
-            goodbye_check = check_for_goodbye(response)
-            if goodbye_check != "continue":
-                if goodbye_check == "angry goodbye":
-                    rich_print(f"\n[bold yellow2]Oooof you made {character} big mad. They left the conversation.[/]\n")
-
-                rich_print("\n[bold]Do you want to save this conversation? ([green]y[/green]/[red]n[/red])[/]\n")
-                save = console.input("\n[bold light_cyan1]You: ")
-                rich_print("\n")
-                if save.lower() == 'n':
-                    conversation_file.close()
-                    os.remove(os.path.join("conversations", filename))
-                    rich_print("\n[bold cyan]Goodbye![/]\n")
-                    exit()
-                else:
-                    rich_print(f"Conversation saved to [bold]conversations/{filename}[/]\n")
-                    conversation_file.close()
-                    exit()
+            goodbye_future = goodbye_executor.submit(timed_check_for_goodbye, response)
 
     finally:
-        conversation_file.close()
+        goodbye_executor.shutdown(wait=False, cancel_futures=True)
+        transcript.close()
+
+# Function to get the result of the goodbye check that ran in the background
+def collect_goodbye_check(goodbye_future, timing, waited=0.0):
+    """
+    Waits for the goodbye check of a reply and records how long it took in the timing of that turn.
+
+    Args:
+        goodbye_future (Future): The running check, resolving to the result of timed_check_for_goodbye.
+        timing (dict): The timing of the turn the reply belongs to.
+        waited (float): Seconds the user already waited for the check before being asked for a message.
+
+    Returns:
+        str: 'goodbye', 'angry goodbye' or 'continue'.
+    """
+    # Only the time spent waiting is added to the turn, the rest overlapped with typing
+    wait_start = time.perf_counter()
+    try:
+        goodbye_check, goodbye_time = goodbye_future.result()
+    except api_errors():
+        # Without an answer the character stays, a missed goodbye is better than a lost conversation
+        goodbye_check, goodbye_time = "continue", time.perf_counter() - wait_start
+    timing['goodbye_check'] = goodbye_time
+    timing['goodbye_wait'] = waited + time.perf_counter() - wait_start
+    return goodbye_check
+
+# Function to tell the user that the character left
+def announce_goodbye(character, goodbye_check, before_message=False):
+    '''Print that the character ended the conversation, angrily or not, and whether the user's last message was sent'''
+    if goodbye_check == "angry goodbye":
+        rich_print(f"\n[bold yellow2]Oooof you made {character} big mad. They left the conversation.[/]\n")
+    elif before_message:
+        rich_print(f"\n[bold]{character} left the conversation before your message was sent.[/]\n")
+    else:
+        rich_print(f"\n[bold]{character} left the conversation.[/]\n")
+
+# Function to ask the user whether to keep the transcript and end the program
+def finish_conversation(transcript, turn_timings, startup_wait):
+    """
+    Asks the user if the conversation should be saved, then closes or discards the transcript and exits.
+
+    Args:
+        transcript (Transcript): The transcript of the conversation.
+        turn_timings (list): The timings collected for each turn.
+        startup_wait (float): Seconds the user waited after the last setup prompt.
+
+    Returns:
+        None
+    """
+    rich_print("\n[bold]Do you want to save this conversation? ([green]y[/green]/[red]n[/red])[/]")
+    save = get_console().input("\n[bold light_cyan1]You: ")
+    if SHOW_TURN_TIMINGS:
+        print_timing_report(turn_timings, startup_wait)
+    if SHOW_CALL_METRICS:
+        print_metrics_summary()
+    if METRICS_PROMETHEUS_PATH:
+        write_prometheus_metrics(METRICS_PROMETHEUS_PATH)
+    if save.lower() == 'n':
+        transcript.discard()
+        rich_print("\n[bold cyan]Goodbye![/]\n")
+    else:
+        transcript.close()
+        rich_print(f"\n[bold cyan]Conversation saved to {transcript.path}[/]\n")
+    exit()
+
+# Function to turn a character's name into part of a filename
+def filename_safe(name):
+    '''Return name with every character that is not a letter, digit or hyphen replaced by "_", so it stays in its folder'''
+    return re.sub(r"[^\w-]", "_", name).strip("_") or "character"
+
+# Append-only JSONL transcripts with an index of every character's sessions
+class TranscriptStore:
+    """
+    Stores each conversation as a JSONL file of timestamped records and keeps a small index file, so
+    the next session id and a character's saved sessions are found without scanning the folder.
+
+    Args:
+        directory (str): The folder holding the transcripts and the index.
+        flush_policy (str): "none" to only write when the transcript is closed, "flush" to flush every
+            record to the operating system, "fsync" to also force every record to disk.
+    """
+    def __init__(self, directory=TRANSCRIPT_DIR, flush_policy=TRANSCRIPT_FLUSH_POLICY):
+        if flush_policy not in ("none", "flush", "fsync"):
+            raise ValueError(f"unknown flush policy: {flush_policy}")
+        self.directory = directory
+        self.flush_policy = flush_policy
+        self.index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+
+    def create_session(self, character, gender, resumed_from=None, source_material=None):
+        '''Allocate the next session id for the character from the source material and return its open Transcript'''
+        with self._changing_index() as index:
+            sessions = self._character_index(index, character)
+            while True:
+                session_id = sessions['next_id']
+                sessions['next_id'] += 1
+                timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M")
+                filename = f"{filename_safe(character)}_{timestamp}_{session_id:02d}.jsonl"
+                try:
+                    transcript = Transcript(self, character, session_id, os.path.join(self.directory, filename))
+                    break
+                except FileExistsError:
+                    # A file left by a store that lost its index, its id is skipped rather than overwritten
+                    continue
+            sessions['sessions'][str(session_id)] = {'filename': filename, 'created': timestamp, 'resumed_from': resumed_from,
+                                                     'source': source_material, 'closed': False}
+
+        transcript.write({'type': 'session', 'character': character, 'source': source_material, 'gender': gender,
+                          'session': session_id, 'resumed_from': resumed_from})
+        return transcript
+
+    def list_sessions(self, character, source_material=None):
+        '''Return the saved sessions of the character, oldest first, each with its id, filename, creation time, source
+        material and whether its transcript was closed. Sessions indexed before closing was recorded count as closed.
+        With a source material, only the sessions with that character from that source material are returned.'''
+        with self._lock:
+            sessions = self._load_index()['characters'].get(character, {'sessions': {}})['sessions']
+        sessions = [{'id': int(session_id), 'closed': True, **session} for session_id, session in sessions.items()]
+        if source_material is not None:
+            # Every Harry is saved under "Harry", only the source material tells them apart
+            sessions = [session for session in sessions
+                        if session.get('source') is not None and normalize_name(session['source']) == normalize_name(source_material)]
+        return sessions
+
+    def close_session(self, character, session_id):
+        '''Record that the session's transcript is complete'''
+        with self._changing_index() as index:
+            session = self._character_index(index, character)['sessions'].get(str(session_id))
+            if session is not None:
+                session['closed'] = True
+
+    def load_session(self, character, session_id):
+        """
+        Loads a saved session back into a conversation list, including the sessions it was resumed from.
+
+        Args:
+            character (str): The character's name.
+            session_id (int): The id of the session.
+
+        Returns:
+            list: The conversation messages, starting with the system message.
+        """
+        with self._lock:
+            session = self._load_index()['characters'][character]['sessions'][str(session_id)]
+
+        conversation = []
+        if session.get('resumed_from') is not None:
+            conversation = self.load_session(character, session['resumed_from'])
+        with open(os.path.join(self.directory, session['filename']), encoding="utf-8") as transcript_file:
+            for line in transcript_file:
+                record = json.loads(line)
+                if record['type'] == 'message':
+                    conversation.append({'role': record['role'], 'content': record['content']})
+        return conversation
+
+    def remove_session(self, character, session_id):
+        '''Forget a session and delete its transcript'''
+        with self._changing_index() as index:
+            session = self._character_index(index, character)['sessions'].pop(str(session_id), None)
+        if session is not None and os.path.exists(os.path.join(self.directory, session['filename'])):
+            os.remove(os.path.join(self.directory, session['filename']))
+
+    @contextlib.contextmanager
+    def _changing_index(self):
+        # Other processes may share the folder, so every change starts from the index on disk and holds a lock file
+        lock_path = f"{self.index_path}.lock"
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            while True:
+                try:
+                    os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    try:
+                        # A lock left behind by a process that crashed is broken once it is old enough
+                        if time.time() - os.path.getmtime(lock_path) > TRANSCRIPT_LOCK_TIMEOUT:
+                            os.remove(lock_path)
+                    except OSError:
+                        pass
+                    time.sleep(0.01)
+            try:
+                index = self._load_index()
+                yield index
+                self._save_index(index)
+            finally:
+                os.remove(lock_path)
+
+    def _character_index(self, index, character):
+        return index['characters'].setdefault(character, {'next_id': 1, 'sessions': {}})
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {'characters': {}}
+
+    def _save_index(self, index):
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, self.index_path)
+
+# One conversation's transcript, written as one JSON record per line
+class Transcript:
+    """
+    An open, append-only transcript created by TranscriptStore.create_session.
+
+    Args:
+        store (TranscriptStore): The store the transcript belongs to.
+        character (str): The character's name.
+        session_id (int): The id of the session.
+        path (str): The path of the JSONL file.
+    """
+    def __init__(self, store, character, session_id, path):
+        self.store = store
+        self.character = character
+        self.session_id = session_id
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "x", encoding="utf-8")
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def append(self, message, usage=None, latency=None):
+        '''Write a conversation message, with the token usage and latency of the request that produced it'''
+        record = {'type': 'message', 'role': message['role'], 'content': message['content']}
+        if usage is not None:
+            record['usage'] = usage
+        if latency is not None:
+            record['latency'] = latency
+        self.write(record)
+
+    def write(self, record):
+        '''Write a timestamped record and flush it according to the store's flush policy'''
+        record = {'ts': datetime.datetime.now().isoformat(timespec="milliseconds"), **record}
+        self._file.write(json.dumps(record) + "\n")
+        if self.store.flush_policy != "none":
+            self._file.flush()
+            if self.store.flush_policy == "fsync":
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        '''Close the transcript, keeping it in the store'''
+        if not self._file.closed:
+            self._file.close()
+            self.store.close_session(self.character, self.session_id)
+
+    def discard(self):
+        '''Close the transcript and remove it from the store'''
+        self.close()
+        self.store.remove_session(self.character, self.session_id)
+
+# create the transcript store used for every conversation
+transcript_store = TranscriptStore()
 
 
 if __name__ == "__main__":
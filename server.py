@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import project
+import prompts
+
+
+# default limits for the multi-session server
+SERVER_HOST="127.0.0.1"
+SERVER_PORT=8765
+MAX_SESSIONS=100
+MAX_INFLIGHT_REQUESTS=16
+MAX_CONNECTIONS=32
+MAX_LINE_BYTES=64 * 1024
+
+
+def main():
+    '''Run the multi-session server until interrupted'''
+    parser = argparse.ArgumentParser(description="Host many Character Chat conversations from one process")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS, help="concurrent sessions before new ones are turned away")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT_REQUESTS, help="concurrent OpenAI requests across all sessions")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="size of the shared HTTP connection pool")
+    parser.add_argument("--metrics-jsonl", default=project.METRICS_JSONL_PATH, help="append every OpenAI call's metrics to this JSONL file")
+    parser.add_argument("--metrics-prometheus", default=project.METRICS_PROMETHEUS_PATH, help="rewrite this Prometheus text file whenever a session ends")
+    args = parser.parse_args()
+
+    if args.metrics_jsonl:
+        project.call_metrics.add_hook(project.JsonlMetricsExporter(args.metrics_jsonl))
+    server = ChatServer(max_sessions=args.max_sessions, max_inflight=args.max_inflight, max_connections=args.max_connections,
+                        metrics_prometheus_path=args.metrics_prometheus)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+# State of one conversation, owned by a single connection
+class ChatSession:
+    """
+    Holds everything that belongs to one conversation, so sessions never share state.
+
+    Args:
+        session_id (int): The id of the session within this server.
+        source_material (str): The source material the character is from.
+        character (str): The character's name.
+        gender (str): The character's gender ('male', 'female', 'diverse').
+        conversation (list): The conversation messages, starting with the system message.
+    """
+    def __init__(self, session_id, source_material, character, gender, conversation):
+        self.session_id = session_id
+        self.character = character
+        self.gender = gender
+        self.conversation = conversation
+        self.context = project.ConversationContext(conversation, character, memory=project.character_memory(source_material, character))
+        self.transcript = project.transcript_store.create_session(character, gender, source_material=source_material)
+        self.transcript.append(conversation[0])
+        self.turn_timings = []
+        self.goodbye_task = None
+        self.ended = False
+
+    def close(self, save=True):
+        '''Close the transcript, discarding it if it should not be saved'''
+        self.ended = True
+        if not self.transcript.closed:
+            if save:
+                self.transcript.close()
+            else:
+                self.transcript.discard()
+
+# Asyncio engine that runs many sessions over one pooled OpenAI client
+class ChatServer:
+    """
+    Serves Character Chat sessions over a line-based JSON protocol. Every connection is one session,
+    all sessions share one async OpenAI client and its connection pool.
+
+    Args:
+        client (AsyncOpenAI): The client to use, one with a pool of max_connections is created if None.
+        max_sessions (int): The number of concurrent sessions before new connections are turned away.
+        max_inflight (int): The number of concurrent OpenAI requests across all sessions.
+        max_connections (int): The size of the shared HTTP connection pool.
+        metrics_prometheus_path (str): A Prometheus text file rewritten with the call metrics whenever a session ends.
+    """
+    def __init__(self, client=None, max_sessions=MAX_SESSIONS, max_inflight=MAX_INFLIGHT_REQUESTS, max_connections=MAX_CONNECTIONS,
+                 metrics_prometheus_path=None):
+        if client is None:
+            import httpx
+            from dotenv import load_dotenv
+            from openai import AsyncOpenAI
+
+            load_dotenv()
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            # Retries are done by project.request_scheduler, shared with every other session
+            client = AsyncOpenAI(max_retries=0, http_client=httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0, connect=10.0)))
+        self.client = client
+        self.max_sessions = max_sessions
+        self.metrics_prometheus_path = metrics_prometheus_path
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.sessions = {}
+        self.connections = 0
+        self._session_ids = itertools.count(1)
+
+    async def serve(self, host=SERVER_HOST, port=SERVER_PORT):
+        '''Accept connections until cancelled'''
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE_BYTES)
+        project.rich_print(f"[bold cyan]Character Chat server listening on {host}:{port}[/]")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        '''Run one session for the lifetime of a connection'''
+        session = None
+        self.connections += 1
+        try:
+            if self.connections > self.max_sessions:
+                await send(writer, {'type': 'error', 'error': 'busy'})
+                return
+
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await send(writer, {'type': 'error', 'error': 'line too long'})
+                    return
+                if not line:
+                    return
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    await send(writer, {'type': 'error', 'error': 'invalid json'})
+                    continue
+
+                if session is None:
+                    session = await self.start_session(request, writer)
+                elif request.get('type') == 'quit':
+                    await self.finish_session(session, writer, save=request.get('save', True))
+                    return
+                elif request.get('type') == 'message':
+                    await self.take_turn(session, request.get('content', ''), writer)
+                else:
+                    await send(writer, {'type': 'error', 'error': 'unknown request'})
+
+                if session is not None and session.ended:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if session is not None:
+                if session.goodbye_task is not None:
+                    session.goodbye_task.cancel()
+                await asyncio.to_thread(session.close)
+                self.sessions.pop(session.session_id, None)
+                if self.metrics_prometheus_path:
+                    project.write_prometheus_metrics(self.metrics_prometheus_path)
+            self.connections -= 1
+            writer.close()
+
+    async def start_session(self, request, writer):
+        '''Validate the requested character and create its session, or report that it does not exist'''
+        if request.get('type') != 'start':
+            await send(writer, {'type': 'error', 'error': 'expected start'})
+            return None
+
+        source_material = request.get('source', '').title()
+        character = request.get('character', '').title()
+        setting = request.get('setting', '')
+
+        try:
+            source_check = await self.validation_completion(project.existence_check_messages(source_material, character), purpose=prompts.EXISTENCE_CHECK.name)
+        except project.api_errors() as error:
+            await send(writer, {'type': 'error', 'error': 'upstream', 'detail': project.describe_api_error(error)})
+            return None
+        character_check = project.parse_character_check(source_check.lower())
+        if character_check is None:
+            await send(writer, {'type': 'error', 'error': 'not found', 'character': character, 'source': source_material})
+            return None
+
+        character_name, gender = character_check
+        conversation = project.initialize_conversation(source_material, character_name, setting)
+        # Creating the transcript rewrites the session index and opening the memory reads SQLite, so both run off the event loop
+        session = await asyncio.to_thread(ChatSession, next(self._session_ids), source_material, character_name, gender, conversation)
+        self.sessions[session.session_id] = session
+        await send(writer, {'type': 'started', 'session': session.session_id, 'character': character_name, 'gender': gender})
+        return session
+
+    async def take_turn(self, session, user_input, writer):
+        '''Send the user's message, stream the reply back and start the goodbye check in the background'''
+        # The goodbye check of the previous reply may already have ended the session
+        if session.goodbye_task is not None:
+            await session.goodbye_task
+            session.goodbye_task = None
+            if session.ended:
+                return
+
+        session.conversation.append({'role': 'user', 'content': user_input})
+        tools = [project.END_CONVERSATION_TOOL] if project.END_DETECTION == "tool" else None
+        try:
+            # Waiting for the memory sync and searching the index block, so they run off the event loop
+            await asyncio.to_thread(session.context.recall)
+            cut = session.context.summary_cut()
+            if cut is not None:
+                summary = session.context.summary
+                for chunk in project.summary_chunks(session.conversation[session.context.summarized_upto:cut]):
+                    summary_messages = project.summary_request_messages(summary, chunk, session.character)
+                    summary = await self.validation_completion(summary_messages, use_cache=False, purpose=prompts.SUMMARY.name)
+                session.context.fold(summary, cut)
+            # Older turns were folded above with the async client, the sync fallback would block the event loop
+            request_messages = session.context.messages_for_request(summarize=False)
+            response, timing, tool_calls = await self.stream_completion(request_messages, writer, tools=tools)
+        except project.api_errors() as error:
+            # The message never got an answer, so it is taken back and the client can send it again
+            session.conversation.pop()
+            await send(writer, {'type': 'error', 'error': 'upstream', 'detail': project.describe_api_error(error)})
+            return
+        session.transcript.append(session.conversation[-1])
+
+        end_signal = None
+        if tools:
+            end_signal, farewell = project.parse_end_signal(tool_calls)
+            if not response.strip():
+                response = farewell
+        timing['prompt_tokens'] = session.context.prompt_tokens
+        session.turn_timings.append(timing)
+        session.conversation.append({'role': 'assistant', 'content': response})
+        session.transcript.append(session.conversation[-1], latency={'first_token': timing['first_token'], 'total': timing['total']}, usage={
+            'prompt_tokens': session.context.prompt_tokens, 'completion_tokens': project.count_tokens(response)
+        })
+        await send(writer, {'type': 'reply', 'content': response, 'timing': timing})
+
+        # The reply already said whether it ends the conversation, so there is nothing to check
+        if end_signal is not None:
+            if end_signal != "continue":
+                await self.finish_session(session, writer, reason=end_signal)
+            return
+        session.goodbye_task = asyncio.create_task(self.check_for_goodbye(session, response, writer))
+
+    async def check_for_goodbye(self, session, response, writer):
+        '''Classify the reply and end the session right away if the character said goodbye'''
+        goodbye_check, confidence = project.classify_goodbye_locally(response)
+        if confidence < project.LOCAL_GOODBYE_THRESHOLD:
+            try:
+                goodbye_check = (await self.validation_completion(project.goodbye_check_messages(response), purpose=prompts.GOODBYE_CHECK.name)).lower()
+            except project.api_errors():
+                # Without an answer the character stays, a missed goodbye is better than a lost conversation
+                return
+
+        if goodbye_check != "continue":
+            await self.finish_session(session, writer, reason=goodbye_check)
+            writer.close()
+
+    async def finish_session(self, session, writer, save=True, reason="quit"):
+        '''Close the session's transcript and tell the client the conversation is over'''
+        # Closing the transcript rewrites the session index, off the event loop like creating it
+        await asyncio.to_thread(session.close, save)
+        await send(writer, {'type': 'end', 'reason': reason, 'saved': save, 'transcript': session.transcript.path if save else None})
+
+    async def stream_completion(self, messages, writer, tools=None):
+        '''Stream the conversation reply to the client token-by-token and return the full text, timings and tool calls.
+        Tokens are buffered in the client's transport while the reply is read, so a slow client never holds an inflight slot.'''
+        model = project.CONVERSATION_MODEL
+        kwargs = {'tools': tools} if tools else {}
+        async with self.inflight:
+            reply = project.StreamedReply(time.perf_counter())
+            stream, retries = await project.request_scheduler.call_async(self.client.chat.completions.create, timeout=project.REQUEST_TIMEOUT,
+                                                                         model=model, messages=messages, temperature=project.CONVERSATION_TEMP,
+                                                                         stream=True, **kwargs)
+            async for chunk in stream:
+                token = reply.add(chunk)
+                if token is not None:
+                    write_event(writer, {'type': 'token', 'content': token})
+
+        result = reply.finish()
+        reply.record(prompts.CONVERSATION.name, model, messages, retries)
+        await writer.drain()
+        return result
+
+    async def validation_completion(self, messages, model=project.VALIDATION_MODEL, temperature=project.VALIDATION_TEMP, use_cache=None, purpose="validation"):
+        '''Async counterpart of project.validation_completion, sharing its on-disk cache and call metrics'''
+        # The cache reads and rewrites its JSON file, so it is used off the event loop
+        key, cached = await asyncio.to_thread(project.lookup_validation_cache, messages, model, temperature, use_cache, purpose)
+        if cached is not None:
+            return cached
+
+        async with self.inflight:
+            start = time.perf_counter()
+            response, retries = await project.request_scheduler.call_async(self.client.chat.completions.create, timeout=project.VALIDATION_TIMEOUT,
+                                                                           hedge_after=project.VALIDATION_HEDGE_AFTER,
+                                                                           model=model, messages=messages, temperature=temperature)
+        project.record_completion(purpose, model, messages, response, time.perf_counter() - start, retries)
+        content = response.choices[0].message.content
+
+        if key is not None:
+            await asyncio.to_thread(project.validation_cache.set, key, content)
+        return content
+
+# Function to write one JSON event to a client, waiting while its buffer is full
+async def send(writer, event):
+    '''Write the event as a JSON line and apply backpressure from slow clients'''
+    write_event(writer, event)
+    await writer.drain()
+
+# Function to buffer one JSON event for a client without waiting for it to be sent
+def write_event(writer, event):
+    '''Write the event as a JSON line to the writer's buffer'''
+    writer.write(json.dumps(event).encode("utf-8") + b"\n")
+
+
+if __name__ == "__main__":
+    main()
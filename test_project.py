@@ -1,6 +1,19 @@
+import json
+import os
 import pytest
 import string
-from project import check_character_existence, initialize_conversation, get_completion_from_messages, validation_completion
+import subprocess
+import sys
+import threading
+import time
+import asyncio
+import memory
+import project
+import prompts
+import benchmark
+import server
+from mock_openai import MockOpenAI, AsyncMockOpenAI, FaultyOpenAI, AsyncFaultyOpenAI
+from project import check_character_existence, initialize_conversation, get_completion_from_messages, validation_completion, stream_completion_from_messages, character_color, timed_check_for_goodbye, ValidationCache, classify_goodbye_locally, LOCAL_GOODBYE_THRESHOLD, ConversationContext, count_message_tokens, TranscriptStore, check_characters_existence, TokenBucket, CallMetrics, conversation_turn, parse_end_signal, RequestScheduler, retry_after
 
 # Define test data
 valid_source_material = ["Harry Potter", "harry ptter", "Harry Potter and the Sorcerer's Stone"]
@@ -90,4 +103,613 @@ def test_validation_completion():
         Do not include punctuation. Respond with all lowercase. Just respond with "working".'''},
     ]
     response = validation_completion(message)
-    assert response == "working"
\ No newline at end of file
+    assert response == "working"
+
+
+# Test stream_completion_from_messages function
+def test_stream_completion_from_messages():
+    messages = [
+        {"role": "user", "content": "Tell me a joke."},
+        {"role": "assistant", "content": "Why did the chicken cross the road?"},
+    ]
+    response, timing = stream_completion_from_messages(messages, valid_characters[0], "male")
+    assert isinstance(response, str)
+    assert response != ""
+    assert 0 < timing["first_token"] <= timing["total"]
+
+# Test character_color function
+def test_character_color():
+    assert character_color("female") == "plum2"
+    assert character_color("diverse") == "light_yellow3"
+    assert character_color("male") == "sea_green3"
+
+# Test timed_check_for_goodbye function
+def test_timed_check_for_goodbye():
+    goodbye_check, duration = timed_check_for_goodbye("Hello! It's great to meet you. What are you doing out here?")
+    assert goodbye_check == "continue"
+    assert duration > 0
+
+# Test ValidationCache class
+def test_validation_cache(tmp_path):
+    cache = ValidationCache(str(tmp_path / "cache.json"), max_entries=2)
+    key = cache.make_key("gpt-3.5-turbo", [{"role": "user", "content": "Is Hermione a character in Harry Potter?"}])
+    assert key == cache.make_key(" GPT-3.5-turbo", [{"role": "user", "content": "is hermione  a character in harry potter?"}])
+    assert cache.get(key) is None
+    cache.set(key, "hermione female")
+    assert cache.get(key) == "hermione female"
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+    # Entries survive a restart and the least recently used one is evicted first
+    cache.set("second", "no")
+    cache.get(key)
+    cache.set("third", "no")
+    reloaded = ValidationCache(str(tmp_path / "cache.json"), max_entries=2)
+    assert reloaded.get(key) == "hermione female"
+    assert reloaded.get("second") is None
+
+def test_validation_cache_ttl(tmp_path):
+    cache = ValidationCache(str(tmp_path / "cache.json"), ttl=-1)
+    cache.set("key", "continue")
+    assert cache.get("key") is None
+
+# Test classify_goodbye_locally function against the labeled fixtures
+def test_classify_goodbye_locally():
+    with open("fixtures/goodbye_replies.json", encoding="utf-8") as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    confident = 0
+    for fixture in fixtures:
+        label, confidence = classify_goodbye_locally(fixture["response"])
+        if confidence >= LOCAL_GOODBYE_THRESHOLD:
+            confident += 1
+            assert label == fixture["label"] == "continue", fixture["response"]
+    # Goodbyes always go to the API check, replies ending in an open question never need to
+    assert confident > 0
+
+def test_classify_goodbye_locally_escalates_unknown_farewells():
+    # Farewells without any of the classifier's keywords still reach the API check
+    for response in ["Get lost!", "We're through.", "Later, Potter.", "Until tomorrow, then.", "Off with you! Where will you go?"]:
+        assert classify_goodbye_locally(response)[1] < LOCAL_GOODBYE_THRESHOLD, response
+
+def test_classify_goodbye_locally_escalates_warnings():
+    label, confidence = classify_goodbye_locally("How dare you speak such profanities! Persist and you'll find my tolerance has its limits")
+    assert confidence < LOCAL_GOODBYE_THRESHOLD
+
+# Test ConversationContext class, older turns are folded into the summary once over budget
+def test_conversation_context(monkeypatch):
+    summarized = []
+    def fake_summarize(summary, messages, character):
+        summarized.append(len(messages))
+        return f"{summary} {len(messages)} messages".strip()
+    monkeypatch.setattr(project, "summarize_conversation", fake_summarize)
+
+    conversation = initialize_conversation(valid_source_material[0], valid_characters[1], setting_list[0])
+    context = ConversationContext(conversation, valid_characters[1], token_budget=2000, min_recent=2)
+    for turn in range(20):
+        conversation.append({"role": "user", "content": f"Question number {turn}, " + "tell me more " * 20})
+        messages = context.messages_for_request()
+        assert messages[0] == conversation[0]
+        assert messages[-1] == conversation[-1]
+        assert context.prompt_tokens == count_message_tokens(messages) <= 2000
+        conversation.append({"role": "assistant", "content": "Well, " + "let me think " * 20})
+
+    # The summary is updated in a few larger steps rather than on every turn
+    assert 0 < len(summarized) < 10
+    assert "messages" in messages[1]["content"]
+
+    # Callers that summarize on their own never trigger a summary here
+    count = len(summarized)
+    conversation.append({"role": "user", "content": "tell me more " * 200})
+    assert context.messages_for_request(summarize=False)[-1] == conversation[-1]
+    assert len(summarized) == count
+
+# Test that importing project has no side effects and does not need an API key
+def test_import_is_lazy():
+    env = {name: value for name, value in os.environ.items() if name != "OPENAI_API_KEY"}
+    code = "import sys, project; print(any(name in sys.modules for name in ('openai', 'rich', 'dotenv')))"
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
+
+    # The memory index doesn't import project, so running project.py as a script never loads it twice
+    result = subprocess.run([sys.executable, "-c", "import sys, memory; print('project' in sys.modules)"], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
+
+# Test TranscriptStore class, sessions are indexed and can be loaded back into a conversation
+def test_transcript_store(tmp_path):
+    store = TranscriptStore(str(tmp_path), flush_policy="fsync")
+    conversation = initialize_conversation(valid_source_material[0], valid_characters[1], setting_list[0])
+    conversation += [{"role": "user", "content": "Hi!"}, {"role": "assistant", "content": "Hello there."}]
+
+    transcript = store.create_session("Hermione", "female")
+    for message in conversation:
+        transcript.append(message, usage={"prompt_tokens": 10, "completion_tokens": 3})
+    transcript.close()
+    assert store.list_sessions("Hermione")[0]["id"] == 1
+    assert store.load_session("Hermione", 1) == conversation
+
+    # A resumed session only stores the new messages but loads the whole conversation
+    resumed = store.create_session("Hermione", "female", resumed_from=1)
+    resumed.append({"role": "user", "content": "Remember me?"})
+    resumed.close()
+    assert store.load_session("Hermione", 2) == conversation + [{"role": "user", "content": "Remember me?"}]
+
+    # Discarded sessions leave the index, ids keep counting up and survive a restart
+    store.create_session("Hermione", "female").discard()
+    reloaded = TranscriptStore(str(tmp_path))
+    assert [session["id"] for session in reloaded.list_sessions("Hermione")] == [1, 2]
+    assert reloaded.create_session("Hermione", "female").session_id == 4
+    assert reloaded.list_sessions("Harry") == []
+
+# Test that two stores on the same folder, like two running CLIs, don't overwrite each other's sessions
+def test_transcript_store_shared_folder(tmp_path):
+    first, second = TranscriptStore(str(tmp_path)), TranscriptStore(str(tmp_path))
+    assert second.list_sessions("Hermione") == []
+    first.create_session("Hermione", "female").close()
+    # Started in the same minute, the second session gets its own id and file instead of crashing
+    second.create_session("Hermione", "female").close()
+    second.create_session("Ron", "male").close()
+    assert [session["id"] for session in first.list_sessions("Hermione")] == [1, 2]
+    assert [session["id"] for session in second.list_sessions("Ron")] == [1]
+    assert not os.path.exists(str(tmp_path / "index.json.lock"))
+
+# Test that sessions are found by the character and the source material together, not the name alone
+def test_transcript_store_source_material(tmp_path):
+    store = TranscriptStore(str(tmp_path))
+    store.create_session("Harry", "male", source_material="Harry Potter").close()
+    store.create_session("Harry", "male", source_material="When Harry Met Sally").close()
+    assert [session["id"] for session in store.list_sessions("Harry", "harry potter")] == [1]
+    assert [session["id"] for session in store.list_sessions("Harry", "When Harry Met Sally")] == [2]
+    assert store.list_sessions("Harry", "Star Wars") == [] and len(store.list_sessions("Harry")) == 2
+
+# Test that a character's name from the model can't put a transcript outside the store's folder
+def test_transcript_store_unsafe_name(tmp_path):
+    store = TranscriptStore(str(tmp_path / "conversations"))
+    transcript = store.create_session("../../x", "female", source_material="Harry Potter")
+    transcript.close()
+    assert os.path.dirname(os.path.abspath(transcript.path)) == str(tmp_path / "conversations")
+    assert os.listdir(tmp_path) == ["conversations"] and store.list_sessions("../../x")[0]["filename"].startswith("x_")
+
+
+# Offline tests against the mock OpenAI backend
+@pytest.fixture
+def mock_client(tmp_path, monkeypatch):
+    client = MockOpenAI()
+    project.set_client(client)
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", False)
+    monkeypatch.setattr(project, "transcript_store", TranscriptStore(str(tmp_path)))
+    yield client
+    project.set_client(None)
+
+def test_check_character_existence_offline(mock_client):
+    assert check_character_existence("Harry Potter", "Hermione") == "hermione female"
+    assert check_character_existence("Family Guy", "Hermione") == "no"
+    assert mock_client.call_count == 2
+
+def test_stream_completion_from_messages_offline(mock_client):
+    response, timing = stream_completion_from_messages([{"role": "user", "content": "Hi!"}], "Hermione", "female")
+    assert response == mock_client.replies[0]
+    assert 0 < timing["first_token"] <= timing["total"]
+
+def test_have_conversation_offline(mock_client):
+    console = benchmark.ScriptedConsole()
+    project.set_console(console)
+    try:
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "", "Hi!", "Tell me about Hogwarts.", "quit"])
+    finally:
+        project.set_console(None)
+    # One existence check and a reply per turn. The first reply ends in an open question and is let through locally,
+    # the second one is sent to the goodbye check
+    assert mock_client.call_count == 4
+    assert len(console.turn_latencies) == 2
+
+def test_have_conversation_goodbye_before_prompt_offline(mock_client):
+    mock_client.replies = ["Farewell, friend. Until next time."]
+    console = benchmark.ScriptedConsole()
+    project.set_console(console)
+    script = iter(["Harry Potter", "Hermione", "", "Hi!", "Are you still there?"])
+    try:
+        benchmark.run_scripted_session(console, script)
+    finally:
+        project.set_console(None)
+    # The character left right after the goodbye, the user was never asked for another message
+    assert next(script, None) == "Are you still there?"
+    assert console.turn_latencies == []
+
+@pytest.mark.parametrize("end_detection", ["separate", "tool"])
+def test_server_offline(tmp_path, monkeypatch, end_detection):
+    monkeypatch.setattr(project, "END_DETECTION", end_detection)
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", False)
+    monkeypatch.setattr(project, "transcript_store", TranscriptStore(str(tmp_path)))
+    chat_server = server.ChatServer(client=AsyncMockOpenAI(replies=["Hello!", "Farewell, friend. Until next time."]))
+    # The session index and the memory are file I/O, which must not block the event loop
+    blocking_threads = []
+    for name, function in [("create_session", project.transcript_store.create_session), ("close_session", project.transcript_store.close_session)]:
+        def record_thread(*args, function=function, **kwargs):
+            blocking_threads.append(threading.current_thread())
+            return function(*args, **kwargs)
+        monkeypatch.setattr(project.transcript_store, name, record_thread)
+    get_memory = project.get_memory
+    monkeypatch.setattr(project, "get_memory", lambda: blocking_threads.append(threading.current_thread()) or get_memory())
+
+    async def run_session():
+        listener = await asyncio.start_server(chat_server.handle_connection, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        events = []
+        for request in [{"type": "start", "source": "Harry Potter", "character": "Hermione"},
+                        {"type": "message", "content": "Hi!"}, {"type": "message", "content": "Bye!"}]:
+            writer.write((json.dumps(request) + "\n").encode("utf-8"))
+        while line := await reader.readline():
+            events.append(json.loads(line))
+        writer.close()
+        listener.close()
+        return events
+
+    events = asyncio.run(run_session())
+    assert events[0]["type"] == "started"
+    assert [event["content"] for event in events if event["type"] == "reply"] == ["Hello!", "Farewell, friend. Until next time."]
+    assert events[-1]["type"] == "end" and events[-1]["reason"] == "goodbye"
+    assert project.transcript_store.load_session("Hermione", 1)[-1]["content"] == "Farewell, friend. Until next time."
+    assert len(blocking_threads) == 3 and threading.main_thread() not in blocking_threads
+
+# Test that a client that stops reading does not keep an inflight request slot after its reply was read
+def test_server_slow_client_offline(monkeypatch):
+    monkeypatch.setattr(project, "call_metrics", CallMetrics())
+
+    class StalledWriter:
+        def __init__(self):
+            self.lines = []
+            self.resume = asyncio.Event()
+
+        def write(self, data):
+            self.lines.append(json.loads(data))
+
+        async def drain(self):
+            await self.resume.wait()
+
+    async def run_turn():
+        chat_server = server.ChatServer(client=AsyncMockOpenAI(replies=["Hello there, how are you?"]), max_inflight=1)
+        writer = StalledWriter()
+        turn = asyncio.create_task(chat_server.stream_completion([{"role": "user", "content": "Hi!"}], writer))
+        await asyncio.wait_for(chat_server.inflight.acquire(), timeout=5)
+        assert not turn.done() and "".join(line["content"] for line in writer.lines) == "Hello there, how are you?"
+        chat_server.inflight.release()
+        writer.resume.set()
+        return await turn
+
+    response, timing, tool_calls = asyncio.run(run_turn())
+    assert response == "Hello there, how are you?" and tool_calls == []
+
+# Test that the server records the same call metrics as the console for the same calls
+def test_server_metrics_match_console_offline(mock_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", True)
+    messages = project.existence_check_messages("Harry Potter", "Hermione")
+    conversation = [{"role": "user", "content": "Farewell!"}]
+    tools = [project.END_CONVERSATION_TOOL]
+    mock_client.replies = ["Goodbye, Harry. Until next time."]
+    chat_server = server.ChatServer(client=AsyncMockOpenAI(replies=mock_client.replies))
+
+    def console_calls():
+        validation_completion(messages, purpose="existence_check")
+        validation_completion(messages, purpose="existence_check")
+        return project.stream_reply(conversation, "Hermione", "female", model=project.CONVERSATION_MODEL, tools=tools)
+
+    async def server_calls():
+        await chat_server.validation_completion(messages, purpose="existence_check")
+        await chat_server.validation_completion(messages, purpose="existence_check")
+        return await chat_server.stream_completion(conversation, DiscardingWriter(), tools=tools)
+
+    class DiscardingWriter:
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            pass
+
+    records = []
+    replies = []
+    for run, name in [(console_calls, "console"), (lambda: asyncio.run(server_calls()), "server")]:
+        monkeypatch.setattr(project, "call_metrics", CallMetrics())
+        monkeypatch.setattr(project, "validation_cache", ValidationCache(str(tmp_path / f"{name}.json")))
+        exported = []
+        project.call_metrics.add_hook(exported.append)
+        replies.append(run())
+        records.append([{key: value for key, value in record.items() if key not in ("ts", "wall_ms", "first_token_ms")}
+                        for record in exported])
+    assert records[0] == records[1] and [record["cached"] for record in records[0]] == [False, True, False]
+    # Both collect the reply and its end_conversation tool call from the same chunks
+    assert replies[0][0] == replies[1][0] and replies[0][2] == replies[1][2] != []
+
+def test_check_characters_existence_offline(mock_client, tmp_path, monkeypatch):
+    mock_client.characters = {**mock_client.characters, ("pride and prejudice", "mary bennet"): "Mary female",
+                              ("pride and prejudice", "mrs bennet"): "Mrs female", ("pride and prejudice", "mr. bennet"): "Mr male",
+                              ("star wars", "r2-d2"): "R2 diverse"}
+    pairs = [("Harry Potter", "Hermione"), ("harry  potter", "HERMIONE"), ("Harry Potter", "Ron"), ("Family Guy", "Hermione"),
+             ("Pride and Prejudice", "Mary Bennet"), ("Pride and Prejudice", "Mrs Bennet"), ("Pride and Prejudice", "Mr. Bennet")]
+    results = check_characters_existence(pairs, pack_size=8)
+    assert [result["name"] for result in results] == ["Hermione", "Hermione", "Ron", None, "Mary", "Mrs", "Mr"]
+    assert [result["exists"] for result in results] == [True, True, True, False, True, True, True]
+    assert results[2]["gender"] == "male" and results[1]["character"] == "HERMIONE"
+    # Case and spacing are deduplicated, similar names are not, and the six distinct pairs share a single request
+    assert mock_client.call_count == 1
+    questions = mock_client.calls[0]["messages"][-1]["content"].splitlines()
+    assert len(questions) == 6
+    # The first of the equivalent pairs is asked about as it was written
+    assert questions[0] == "1. Is Hermione a character in Harry Potter?" and questions[-1] == "6. Is Mr. Bennet a character in Pride and Prejudice?"
+
+    # A pair answered by a single check before is found in the cache under the same key
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", True)
+    monkeypatch.setattr(project, "validation_cache", ValidationCache(str(tmp_path / "cache.json")))
+    check_character_existence("Star Wars", "R2-D2")
+    assert check_characters_existence([("Star Wars", "R2-D2"), ("star wars", "r2 d2")])[1]["name"] == "R2"
+    assert mock_client.call_count == 2
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.07
+
+def test_call_metrics_offline(mock_client, monkeypatch):
+    metrics = CallMetrics()
+    monkeypatch.setattr(project, "call_metrics", metrics)
+    exported = []
+    metrics.add_hook(exported.append)
+
+    check_character_existence("Harry Potter", "Hermione")
+    stream_completion_from_messages([{"role": "user", "content": "Hi!"}], "Hermione", "female")
+    assert [record["purpose"] for record in exported] == ["existence_check", "conversation"]
+    assert exported[0]["prompt_tokens"] > 0 and exported[0]["cost"] > 0
+    assert exported[1]["streamed"] and exported[1]["first_token_ms"] <= exported[1]["wall_ms"]
+
+    rows = {row["purpose"]: row for row in metrics.summary()}
+    assert rows["conversation"]["model"] == project.CONVERSATION_MODEL
+    assert rows["existence_check"]["calls"] == 1
+    assert 'character_chat_calls_total{purpose="conversation",model="gpt-4"} 1' in metrics.prometheus_text()
+
+def test_parse_end_signal():
+    assert parse_end_signal([]) == ("continue", "")
+    assert parse_end_signal([("end_conversation", '{"signal": "angry goodbye"}')]) == ("angry goodbye", "")
+    assert parse_end_signal([("end_conversation", '{"signal": "goodbye", "farewell": "Bye!"}')]) == ("goodbye", "Bye!")
+    # A garbled call still ends the conversation
+    assert parse_end_signal([("end_conversation", '{"signal": "goo')]) == ("goodbye", "")
+
+@pytest.mark.parametrize("stream", [True, False])
+@pytest.mark.parametrize("tool_call_only", [True, False])
+def test_conversation_turn_offline(mock_client, monkeypatch, stream, tool_call_only):
+    monkeypatch.setattr(project, "STREAM_RESPONSES", stream)
+    mock_client.tool_call_only = tool_call_only
+    mock_client.replies = ["What a lovely day.", "Get out of my sight! I'm done with you."]
+    messages = [{"role": "user", "content": "Hi!"}]
+
+    assert conversation_turn(messages, "Hermione", "female", end_detection="tool")[2] == "continue"
+    messages += [{"role": "assistant", "content": "What a lovely day."}, {"role": "user", "content": "You're a know-it-all."}]
+    response, timing, end_signal = conversation_turn(messages, "Hermione", "female", end_detection="tool")
+    assert (response, end_signal) == ("Get out of my sight! I'm done with you.", "angry goodbye")
+    assert conversation_turn(messages, "Hermione", "female", end_detection="separate")[2] is None
+    assert "tools" not in mock_client.calls[-1]
+
+def test_have_conversation_tool_end_detection_offline(mock_client, monkeypatch):
+    monkeypatch.setattr(project, "END_DETECTION", "tool")
+    mock_client.replies = ["Hello!", "Farewell, friend. Until next time."]
+    console = benchmark.ScriptedConsole()
+    project.set_console(console)
+    try:
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "", "Hi!", "Bye!", "Are you still there?"])
+    finally:
+        project.set_console(None)
+    # The goodbye ends the session right after the reply, without a goodbye check
+    assert mock_client.call_count == 3
+    assert all("tools" in call for call in mock_client.calls[1:])
+    assert project.transcript_store.list_sessions("Hermione") == []
+
+@pytest.fixture
+def fast_scheduler(monkeypatch):
+    scheduler = RequestScheduler(max_retries=3, base_delay=0.01)
+    monkeypatch.setattr(project, "request_scheduler", scheduler)
+    return scheduler
+
+def test_request_scheduler_retries_offline(mock_client, fast_scheduler, monkeypatch):
+    metrics = CallMetrics()
+    monkeypatch.setattr(project, "call_metrics", metrics)
+    client = FaultyOpenAI(faults=["rate_limit", "server_error", "timeout"])
+    project.set_client(client)
+    monkeypatch.setattr(project, "VALIDATION_TIMEOUT", 0.05)
+
+    assert check_character_existence("Harry Potter", "Ron") == "ron male"
+    assert client.injected == ["rate_limit", "server_error", "timeout", None]
+    assert metrics.summary()[0]["retries"] == 3
+
+    # Once the retries run out the error is raised
+    client.faults = ["server_error"] * 4
+    with pytest.raises(Exception) as error:
+        check_character_existence("Harry Potter", "Harry")
+    assert error.value.status_code == 500
+
+def test_request_scheduler_hedge_offline(fast_scheduler):
+    client = FaultyOpenAI(faults=["slow"], slow_latency=2.0)
+    start = time.perf_counter()
+    response, retries = fast_scheduler.call(client.chat.completions.create, hedge_after=0.05,
+                                            model="gpt-3.5-turbo", messages=[{"role": "user", "content": "Hi!"}])
+    # The duplicate answered long before the slow request would have
+    assert time.perf_counter() - start < 1.0
+    assert response.choices[0].message.content and retries == 0 and fast_scheduler.hedged == 1
+
+    async def hedge():
+        async_client = AsyncFaultyOpenAI(faults=["slow"], slow_latency=2.0)
+        return await fast_scheduler.call_async(async_client.chat.completions.create, hedge_after=0.05,
+                                               model="gpt-3.5-turbo", messages=[{"role": "user", "content": "Hi!"}])
+    start = time.perf_counter()
+    asyncio.run(hedge())
+    assert time.perf_counter() - start < 1.0 and fast_scheduler.hedged == 2
+
+def test_retry_after():
+    import httpx
+    import openai
+
+    def rate_limit_error(headers):
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        return openai.RateLimitError("Rate limit", response=httpx.Response(429, headers=headers, request=request), body=None)
+
+    assert retry_after(rate_limit_error({"retry-after-ms": "250"})) == 0.25
+    assert retry_after(rate_limit_error({"retry-after": "2"})) == 2.0
+    assert retry_after(rate_limit_error({"x-ratelimit-reset-requests": "1m30s", "x-ratelimit-reset-tokens": "250ms"})) == 90.0
+    assert retry_after(rate_limit_error({})) is None
+    # Waiting longer than max_delay is not worth it
+    assert RequestScheduler(max_delay=30).retry_delay(rate_limit_error({"retry-after": "60"}), 0) is None
+    assert 2.0 <= RequestScheduler(max_delay=30).retry_delay(rate_limit_error({"retry-after": "2"}), 0) < 3.0
+    assert RequestScheduler().retry_delay(ValueError("not an API error"), 0) is None
+
+def test_have_conversation_api_error_offline(mock_client, monkeypatch):
+    monkeypatch.setattr(project, "request_scheduler", RequestScheduler(max_retries=0))
+    client = FaultyOpenAI(faults=[None, "server_error"])
+    project.set_client(client)
+    console = benchmark.ScriptedConsole()
+    project.set_console(console)
+    try:
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "", "Hi!", "Hi again!", "quit"])
+    finally:
+        project.set_console(None)
+    # The failed message was taken back, so the retry is the only user message sent
+    assert client.injected == [None, "server_error", None]
+    assert [message["content"] for message in client.calls[-1]["messages"] if message["role"] == "user"] == ["Hi again!"]
+
+def test_server_upstream_error_offline(tmp_path, monkeypatch):
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", False)
+    monkeypatch.setattr(project, "transcript_store", TranscriptStore(str(tmp_path)))
+    monkeypatch.setattr(project, "request_scheduler", RequestScheduler(max_retries=0))
+    chat_server = server.ChatServer(client=AsyncFaultyOpenAI(faults=[None, "rate_limit"], replies=["Hello!"]))
+
+    async def run_session():
+        listener = await asyncio.start_server(chat_server.handle_connection, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        events = []
+        for request in [{"type": "start", "source": "Harry Potter", "character": "Hermione"},
+                        {"type": "message", "content": "Hi!"}, {"type": "message", "content": "Hi!"}, {"type": "quit"}]:
+            writer.write((json.dumps(request) + "\n").encode("utf-8"))
+        while line := await reader.readline():
+            events.append(json.loads(line))
+        writer.close()
+        listener.close()
+        return events
+
+    events = asyncio.run(run_session())
+    assert [event["type"] for event in events if event["type"] != "token"] == ["started", "error", "reply", "end"]
+    assert events[1]["error"] == "upstream"
+    assert [message["role"] for message in project.transcript_store.load_session("Hermione", 1)] == ["system", "user", "assistant"]
+
+def test_main_pipelined_startup_offline(mock_client):
+    mock_client.latency = 0.2
+    console = benchmark.ScriptedConsole(typing_delay=0.3)
+    project.set_console(console)
+    try:
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "in the library", "quit"])
+    finally:
+        project.set_console(None)
+    # The existence check and the warm-up ran while the setting was typed
+    assert console.startup_latencies[0] < 0.1
+    assert mock_client.warmed_up == 1 and mock_client.call_count == 1
+
+def test_main_invalid_character_offline(mock_client):
+    console = benchmark.ScriptedConsole()
+    project.set_console(console)
+    try:
+        with pytest.raises(SystemExit):
+            console.start(["Family Guy", "Hermione", "in the library", "Hi!"])
+            project.main()
+    finally:
+        project.set_console(None)
+    assert mock_client.call_count == 1
+    assert console.startup_latencies == [] and project.transcript_store.list_sessions("Hermione") == []
+
+# Test MemoryIndex, past exchanges are ranked with BM25 and follow the sessions of the TranscriptStore
+def test_memory_index(tmp_path):
+    store = TranscriptStore(str(tmp_path))
+    index = memory.MemoryIndex(str(tmp_path / "memory.sqlite3"), count_tokens=project.count_tokens)
+    exchanges = [
+        ("Do you like Quidditch?", "I'd rather be in the library than on a broomstick."),
+        ("What did you think of the troll?", "It was terrifying, Harry and Ron saved me in the bathroom."),
+        ("Any plans for the summer?", "Reading ahead for next year, of course."),
+    ]
+    for session_exchanges in (exchanges[:2], exchanges[2:]):
+        transcript = store.create_session("Hermione", "female", source_material="Harry Potter")
+        transcript.append({"role": "system", "content": "You are Hermione."})
+        for user_message, reply in session_exchanges:
+            transcript.append({"role": "user", "content": user_message})
+            transcript.append({"role": "assistant", "content": reply})
+        transcript.close()
+
+    assert index.sync(store, "Harry Potter", "Hermione") == 2 and index.sync(store, "harry potter", "Hermione") == 0
+    assert index.stats("Harry Potter", "Hermione") == {"sessions": 2, "exchanges": 3}
+    assert index.search("Harry Potter", "Hermione", "Remember the troll in the bathroom?")[0]["reply"].startswith("It was terrifying")
+    assert index.search("Harry Potter", "Hermione", "the and of") == [] and index.search("Harry Potter", "Harry", "troll") == []
+
+    # Recalled exchanges fit the budget and come in the order they happened, the most recent ones if none is relevant
+    recalled = index.recall("Harry Potter", "Hermione", "troll summer reading", token_budget=1000, max_exchanges=2)
+    assert [exchange["user"] for exchange in recalled] == ["What did you think of the troll?", "Any plans for the summer?"]
+    assert len(index.recall("Harry Potter", "Hermione", "troll summer reading", token_budget=20, max_exchanges=2)) == 1
+    assert [exchange["user"] for exchange in index.recall("Harry Potter", "Hermione", "dragons", token_budget=1000, max_exchanges=1)] == ["Any plans for the summer?"]
+
+    store.remove_session("Hermione", 1)
+    index.sync(store, "Harry Potter", "Hermione")
+    assert index.stats("Harry Potter", "Hermione") == {"sessions": 1, "exchanges": 1}
+    assert index.search("Harry Potter", "Hermione", "troll") == []
+
+    # Another Hermione is another character, she does not remember the chats with the one from Harry Potter
+    assert index.sync(store, "Hermione Granger Fan Fiction", "Hermione") == 0
+    assert index.search("Hermione Granger Fan Fiction", "Hermione", "summer") == []
+    assert index.recall("Hermione Granger Fan Fiction", "Hermione", "dragons", token_budget=1000, max_exchanges=1) == []
+
+def test_have_conversation_memory_offline(mock_client):
+    # Both sessions are saved through main(), so the first is only remembered if it is indexed once it is complete
+    console = benchmark.ScriptedConsole(save=True)
+    project.set_console(console)
+    try:
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "", "What did you think of the troll?", "quit"])
+        benchmark.run_scripted_session(console, ["Harry Potter", "Hermione", "", "Was the troll scary?", "quit"])
+    finally:
+        project.set_console(None)
+    request = mock_client.calls[-1]["messages"]
+    assert request[1]["role"] == "system" and "What did you think of the troll?" in request[1]["content"]
+    assert project.get_memory().stats("Harry Potter", "Hermione") == {"sessions": 1, "exchanges": 1}
+
+# Test the prompt templates, every call of a kind starts with the same instructions and its details come after them
+def test_prompt_prefixes():
+    first = initialize_conversation("Harry Potter", "Hermione", "in the Great Hall")[0]["content"]
+    second = initialize_conversation("Pride and Prejudice", "Elizabeth", "")[0]["content"]
+    instructions = prompts.CONVERSATION.instructions
+    assert first.startswith(instructions) and second.startswith(instructions)
+    assert "Elizabeth from Pride and Prejudice" in second[len(instructions):] and "```in the Great Hall```" in first[len(instructions):]
+
+    assert project.existence_check_messages("Harry Potter", "Ron")[0] == project.existence_check_messages("Narnia", "Aslan")[0]
+    assert project.goodbye_check_messages("Farewell!")[0] == project.goodbye_check_messages("How are you?")[0]
+    summaries = [project.summary_request_messages("", [{"role": "user", "content": "Hi"}], character) for character in ("Ron", "Harry")]
+    assert summaries[0][0] == summaries[1][0] and "```Ron```" in summaries[0][1]["content"]
+    # Braces in the details are kept as they are
+    assert project.goodbye_check_messages("{not a field}")[1]["content"] == "```{not a field}```"
+
+# Test that summaries never reach the validation cache, they hold the conversation itself
+def test_summarize_conversation_uncached_offline(mock_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(project, "VALIDATION_CACHE_ENABLED", True)
+    monkeypatch.setattr(project, "validation_cache", ValidationCache(str(tmp_path / "cache.json")))
+    summary = project.summarize_conversation("", [{"role": "user", "content": "My owl is called Errol."}], "Ron")
+    assert summary and project.validation_cache.stats()["entries"] == 0
+
+# Test that a long history is folded into the summary in chunks that each fit in a request
+def test_summarize_conversation_chunks_offline(mock_client, monkeypatch):
+    monkeypatch.setattr(project, "SUMMARY_CHUNK_TOKENS", 200)
+    history = [{"role": "user" if turn % 2 == 0 else "assistant", "content": f"Turn {turn}, " + "more about Hogwarts " * 15}
+               for turn in range(20)]
+    history.append({"role": "user", "content": "the longest message " * 500})
+    chunks = project.summary_chunks(history, token_limit=200)
+    assert [message["content"][:8] for chunk in chunks for message in chunk][:20] == [message["content"][:8] for message in history[:20]]
+    assert all(sum(project.count_tokens(message["content"], project.VALIDATION_MODEL) for message in chunk) <= 200 for chunk in chunks)
+    assert chunks[-1][0]["content"].startswith("the longest message")
+
+    summary = project.summarize_conversation("", history, "Hermione")
+    assert summary and mock_client.call_count == len(project.summary_chunks(history)) > 1
+    # Every request is the instructions, the summary so far and one chunk, with a speaker name on each of its lines
+    instructions = count_message_tokens(prompts.SUMMARY.messages(character="Hermione", summary="", transcript=""))
+    for call, chunk in zip(mock_client.calls, project.summary_chunks(history)):
+        assert count_message_tokens(call["messages"]) <= instructions + project.count_tokens(summary) + 200 + 4 * len(chunk)